@@ -0,0 +1,180 @@
+import os
+import math
+import json
+from collections import deque
+
+import numpy as np
+
+from pricematrix import PriceMatrix
+from pricestore import write_atomic
+
+STATE_DIR = 'data/analytics/'
+STATS = ('twap', 'volatility', 'min', 'max')
+
+class RollingStats:
+    # statistics of the prices in a rolling window of the last window slots of a
+    # price history, updated in constant time as each slot is added:
+    #     twap        mean price over the window (the slots are equally spaced)
+    #     volatility  standard deviation of the log returns between the slots
+    #     min, max    lowest and highest price
+    # Slots without a price (0 or NaN in a history) are left out, as are the returns
+    # to and from them. The state can be saved and loaded, so that the statistics of
+    # a history which grows can be kept up to date without going over it again
+    def __init__(self, window, start_index=0):
+        self.window = window
+        self.start_index = start_index # slot index of the first price added
+        self.count = 0                 # number of prices added so far
+        self.prices = deque()   # last window prices, None where there is no price
+        self.returns = deque()  # log returns into the last window - 1 slots
+        self.mins = deque()     # (position, price) of increasing prices in the window
+        self.maxs = deque()     # (position, price) of decreasing prices in the window
+        self.resum()
+
+    @property
+    def next_index(self):
+        # slot index of the next price to be added
+        return self.start_index + self.count
+
+    def resum(self):
+        # recalculate the running sums from the window, which is done every window
+        # updates so that rounding errors don't build up
+        prices = [p for p in self.prices if p is not None]
+        returns = [r for r in self.returns if r is not None]
+        self.price_sum, self.price_count = math.fsum(prices), len(prices)
+        self.return_sum, self.return_count = math.fsum(returns), len(returns)
+        self.return_sq_sum = math.fsum(r * r for r in returns)
+
+    def update(self, price):
+        if not price or price != price:
+            price = None
+        prev = self.prices[-1] if self.prices else None
+        ret = math.log(price / prev) if price is not None and prev is not None else None
+
+        self.prices.append(price)
+        self.add_price(price, 1)
+        if len(self.prices) > self.window:
+            self.add_price(self.prices.popleft(), -1)
+        if self.window > 1:
+            self.returns.append(ret)
+            self.add_return(ret, 1)
+            if len(self.returns) > self.window - 1:
+                self.add_return(self.returns.popleft(), -1)
+
+        position = self.count
+        if price is not None:
+            while self.mins and self.mins[-1][1] >= price:
+                self.mins.pop()
+            self.mins.append((position, price))
+            while self.maxs and self.maxs[-1][1] <= price:
+                self.maxs.pop()
+            self.maxs.append((position, price))
+        for extremes in (self.mins, self.maxs):
+            while extremes and extremes[0][0] <= position - self.window:
+                extremes.popleft()
+
+        self.count += 1
+        if self.count % self.window == 0:
+            self.resum()
+
+    def add_price(self, price, sign):
+        if price is not None:
+            self.price_sum += sign * price
+            self.price_count += sign
+
+    def add_return(self, ret, sign):
+        if ret is not None:
+            self.return_sum += sign * ret
+            self.return_sq_sum += sign * ret * ret
+            self.return_count += sign
+
+    @property
+    def twap(self):
+        return self.price_sum / self.price_count if self.price_count else None
+
+    @property
+    def volatility(self):
+        n = self.return_count
+        if n < 2:
+            return None
+        var = (self.return_sq_sum - self.return_sum ** 2 / n) / (n - 1)
+        return math.sqrt(max(var, 0))
+
+    @property
+    def min(self):
+        return self.mins[0][1] if self.mins else None
+
+    @property
+    def max(self):
+        return self.maxs[0][1] if self.maxs else None
+
+    def extend(self, prices):
+        # add prices for the next slots, returning a dict of arrays holding each of
+        # the statistics after every slot (NaN where they are undefined)
+        series = {stat: np.full(len(prices), np.nan) for stat in STATS}
+        for i, price in enumerate(np.asarray(prices, dtype=float).tolist()):
+            self.update(price)
+            for stat in STATS:
+                value = getattr(self, stat)
+                if value is not None:
+                    series[stat][i] = value
+        return series
+
+    def as_dict(self):
+        return {'window': self.window, 'start_index': self.start_index,
+                'count': self.count, 'prices': list(self.prices),
+                'returns': list(self.returns), 'mins': list(self.mins),
+                'maxs': list(self.maxs)}
+
+    @classmethod
+    def from_dict(cls, state):
+        stats = cls(state['window'], state['start_index'])
+        stats.count = state['count']
+        stats.prices = deque(state['prices'])
+        stats.returns = deque(state['returns'])
+        stats.mins = deque(tuple(m) for m in state['mins'])
+        stats.maxs = deque(tuple(m) for m in state['maxs'])
+        stats.resum()
+        return stats
+
+    def save(self, filename):
+        write_atomic(filename, json.dumps(self.as_dict()))
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls.from_dict(json.load(f))
+
+def rolling(prices, window):
+    # the statistics over a rolling window for every slot of a list of prices
+    return RollingStats(window).extend(prices)
+
+def rolling_matrix(matrix, window, stat='twap'):
+    # one of the statistics for every row and column of a PriceMatrix, such as
+    # that of AssetRegister.get_price_time_series, as a PriceMatrix
+    values = np.full(matrix.values.shape, np.nan)
+    for j in range(len(matrix.symbols)):
+        values[:, j] = rolling(matrix.values[:, j], window)[stat]
+    return PriceMatrix(matrix.times, matrix.symbols, values, matrix.start_index,
+                       matrix.delta)
+
+def update_stats(asset_register, identifier, window, state_dir=STATE_DIR):
+    # bring the saved rolling statistics of a token's price history up to date,
+    # adding only the slots after those already seen. Returns the RollingStats,
+    # along with the statistics after each of the slots which were added
+    address = asset_register.get_token_info(identifier)['address']
+    history = asset_register.price_histories[address]
+    filename = os.path.join(state_dir, f"{address.lower()}.{window}.stats.json")
+    end = history['start_index'] + len(history['prices'])
+    try:
+        stats = RollingStats.load(filename)
+    except FileNotFoundError:
+        stats = None
+    # start again if the history has been recalculated from a different slot
+    if stats is None or stats.start_index != history['start_index'] or \
+       stats.next_index > end:
+        stats = RollingStats(window, history['start_index'])
+
+    series = stats.extend(history['prices'][stats.next_index - history['start_index']:])
+    os.makedirs(state_dir, exist_ok=True)
+    stats.save(filename)
+    return stats, series
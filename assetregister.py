@@ -1,11 +1,21 @@
+import os
 import time
 import json
-import fjson
 import yaml
+from functools import lru_cache
 
-from web3 import Web3
+from eth_utils import encode_hex, event_abi_to_log_topic
 from blocktimes import Blocktimes
-from utils import find_first_change, progress_string
+from utils import find_first_change, progress_string, retry
+from metrics import metrics
+from pricematrix import PriceMatrix
+from pricestore import (CHECKPOINT_INTERVAL, CHECKPOINT_SLOTS, Checkpointer,
+                        export_json, load_prices, save_prices, saved_length,
+                        write_atomic)
+from pricestream import READ_CHUNK, history_pieces, stream_chunks, stream_records
+from rpc import (BATCH_SIZE, LOG_CHUNK_SIZE, batch_request, block_param, connect, eth_call,
+                 get_logs)
+from rpccache import DEFAULT_FILENAME as RPC_CACHE_FILENAME
 
 NODE_URL = 'http://localhost:8545'
 UNISWAP_V1_FAC_ADR = '0xc0a47dFe034B400B47bDaD5FecDa2621de6c4d95'
@@ -15,11 +25,21 @@ UNISWAP_V2_DEPLOY_BLOCK = 10000835
 WETH_ADR = '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2'
 DATA_DIR = 'data/'
 ABI_DIR = 'abi/'
-BLOCKTIMES_FILENAME = DATA_DIR + 'blocktimes.json'
+BLOCKTIMES_FILENAME = DATA_DIR + 'blocktimes.bin'
 TOKENS_FILENAME = 'tokens.yaml'
 TOKENS_EXPORT_FILENAME = DATA_DIR + 'tokens.json'
-FLOAT_FORMAT = '.5e'
+EXCHANGES_FILENAME = DATA_DIR + 'exchanges.json'
+PRICES_EXTENSION = '.prices'
+LOG_STEP = 1000 # number of slots priced per pass when replaying exchange events
 NOCODE = b''
+# V1 exchange events which change the pools, with the (argument, sign) of the
+# change to the ether and token balances respectively
+V1_POOL_EVENTS = {
+    'TokenPurchase': (('eth_sold', 1), ('tokens_bought', -1)),
+    'EthPurchase': (('eth_bought', -1), ('tokens_sold', 1)),
+    'AddLiquidity': (('eth_amount', 1), ('token_amount', 1)),
+    'RemoveLiquidity': (('eth_amount', -1), ('token_amount', -1))
+}
 
 with open(ABI_DIR + 'uniswap_v1_factory.json') as f:
     UNISWAP_V1_FAC_ABI = json.load(f)
@@ -31,25 +51,53 @@ with open(ABI_DIR + 'uniswap_v2_exchange.json') as f:
     UNISWAP_V2_EXC_ABI = json.load(f)
 
 class AssetRegister:
-    exchanges_v1 = {}
-    exchanges_v2 = {}
     price_histories = {}
     token_lookup = {}
 
     def __init__(self, node_url=NODE_URL, tokens_filename=TOKENS_FILENAME,
-                 blocktimes_filename=BLOCKTIMES_FILENAME):
-
-        self.web3 = Web3(Web3.HTTPProvider(node_url))
-        with open(tokens_filename) as f:
-            self.token_lookup = yaml.full_load(f)
-
-        try:
-            with open(blocktimes_filename) as f:
+                 blocktimes_filename=BLOCKTIMES_FILENAME,
+                 exchanges_filename=EXCHANGES_FILENAME,
+                 rpc_cache_filename=RPC_CACHE_FILENAME):
+
+        # requests at historical blocks are answered from rpc_cache_filename where
+        # possible, unless it is None
+        self.node_url = node_url
+        self.web3 = connect(node_url, rpc_cache_filename)
+        self.token_lookup = {}
+        if tokens_filename:
+            with open(tokens_filename) as f:
+                self.token_lookup = yaml.full_load(f)
+
+        # exchange objects of each register, which use its own connection (that of
+        # a ShardedPriceEngine worker, say), built from the metadata when first used
+        self.exchanges_v1 = {}
+        self.exchanges_v2 = {}
+
+        # exchange metadata (address, decimals, deploy block) found for each token,
+        # keyed by lowercase token address, so it only has to be looked up once. It
+        # is only kept in memory if exchanges_filename is None
+        self.exchanges_filename = exchanges_filename
+        self.exchange_metadata = {}
+        if exchanges_filename:
+            try:
+                with open(exchanges_filename) as f:
+                    self.exchange_metadata = json.load(f)
+            except FileNotFoundError:
                 pass
-            self.blocktimes = Blocktimes(filename=blocktimes_filename)
-        except FileNotFoundError:
-            print('no blocktimes file found, calculating from genesis')
-            self.blocktimes = Blocktimes()
+
+        # a register without blocktimes (blocktimes_filename None) can only price
+        # given blocks, as the worker processes of a ShardedPriceEngine do
+        self.blocktimes = None
+        if blocktimes_filename:
+            # fall back to a sequence saved in the original JSON format
+            for filename in (blocktimes_filename,
+                             os.path.splitext(blocktimes_filename)[0] + '.json'):
+                if os.path.exists(filename):
+                    self.blocktimes = Blocktimes(filename=filename, web3=self.web3)
+                    break
+            else:
+                print('no blocktimes file found, calculating from genesis')
+                self.blocktimes = Blocktimes(web3=self.web3)
 
     def add_all_assets(self):
         for sym in self.token_lookup:
@@ -61,14 +109,38 @@ class AssetRegister:
 
         print(f"adding {symbol} ({address})")
 
-        v1_exchange = UniswapV1Exchange(self.web3, address)
+        # exchanges which were missing are recorded too, with the block they were
+        # looked for at, and only have to be looked up again once they exist
+        metadata = self.exchange_metadata.get(address.lower(), {})
+        v1_metadata = UniswapV1Exchange.check_metadata(self.web3, address, metadata.get('v1'))
+        v2_metadata = UniswapV2Exchange.check_metadata(self.web3, address, metadata.get('v2'))
+        v1_exchange = UniswapV1Exchange(self.web3, address, v1_metadata)
+        v2_exchange = UniswapV2Exchange(self.web3, address, metadata=v2_metadata)
         self.exchanges_v1[address] = v1_exchange
-        self.exchanges_v2[address] = UniswapV2Exchange(self.web3, address)
+        self.exchanges_v2[address] = v2_exchange
+
+        new_metadata = {'v1': v1_exchange.metadata, 'v2': v2_exchange.metadata}
+        if new_metadata != metadata:
+            self.exchange_metadata[address.lower()] = new_metadata
+            self.save_exchange_metadata()
         try:
-            with open(DATA_DIR + address.lower() + '.json') as f:
-                self.price_histories[address] = json.load(f)
+            self.price_histories[address] = load_prices(self.price_filename(address))
         except FileNotFoundError:
-            print('no price history found for ' + symbol)
+            # fall back to a history saved in the original JSON format
+            try:
+                with open(self.price_filename(address, '.json')) as f:
+                    self.price_histories[address] = json.load(f)
+            except FileNotFoundError:
+                print('no price history found for ' + symbol)
+
+    def save_exchange_metadata(self):
+        if self.exchanges_filename is None:
+            return
+        write_atomic(self.exchanges_filename,
+                     json.dumps(self.exchange_metadata, indent=1, sort_keys=True))
+
+    def price_filename(self, address, extension=PRICES_EXTENSION):
+        return DATA_DIR + address.lower() + extension
 
     def get_token_info(self, identifier):
         if self.web3.isAddress(identifier):
@@ -116,10 +188,49 @@ class AssetRegister:
             pool_B2, eth_B2 = exchange_B2.get_pools(block)
             pool_A2, pool_B2 = reweight_pools(pool_A2, eth_A2, pool_B2, eth_B2)
 
-        if pool_A1 + pool_A2 == 0:
-            return None
-        else:
-            return (pool_B1 + pool_B2) / (pool_A1 + pool_A2)
+        return combine_pools(pool_A1, pool_B1, pool_A2, pool_B2)
+
+    def get_prices_in_eth(self, identifier, blocks, batch_size=BATCH_SIZE):
+        # equivalent to calling get_price_in_eth for each block, but with the pool
+        # balance requests for all blocks packed into JSON-RPC batches
+        return [combine_pools(*pools)
+                for pools in self.get_pools_in_eth(identifier, blocks, batch_size)]
+
+    def get_prices_in_eth_from_logs(self, identifier, blocks, chunk_size=LOG_CHUNK_SIZE):
+        # get_prices_in_eth for an ascending list of blocks, but with the pools
+        # reconstructed from exchange events rather than polled at every block. The
+        # events only follow the exchange's own accounting, so tokens sent straight
+        # to an exchange, or whose balances change by themselves (fee on transfer or
+        # rebasing tokens), make the prices differ from the polled ones until the
+        # next pass (every LOG_STEP slots) reads the balances again
+        return [combine_pools(*pools) for pools in
+                self.get_pools_in_eth_from_logs(identifier, blocks, chunk_size)]
+
+    def get_pools_in_eth(self, identifier, blocks, batch_size=BATCH_SIZE):
+        # (V1 token, V1 ether, V2 token, V2 ether) pool balances for each block
+        exchanges = (self.get_exchange(identifier, uniswap_version=1),
+                     self.get_exchange(identifier, uniswap_version=2))
+        if not batch_size:
+            return [exchanges[0].get_pools(n) + exchanges[1].get_pools(n)
+                    for n in blocks]
+
+        pool_requests = [ex.get_pools_requests(n) for n in blocks for ex in exchanges]
+        results = batch_request(self.web3, [r for reqs in pool_requests for r in reqs],
+                                batch_size)
+
+        pools, k = [], 0
+        for i, reqs in enumerate(pool_requests):
+            pools += exchanges[i % 2].decode_pools(results[k:k+len(reqs)])
+            k += len(reqs)
+
+        return [tuple(pools[i:i+4]) for i in range(0, len(pools), 4)]
+
+    def get_pools_in_eth_from_logs(self, identifier, blocks, chunk_size=LOG_CHUNK_SIZE):
+        pools_1 = self.get_exchange(identifier, uniswap_version=1) \
+                      .get_pools_history(blocks, chunk_size)
+        pools_2 = self.get_exchange(identifier, uniswap_version=2) \
+                      .get_pools_history(blocks, chunk_size)
+        return [p1 + p2 for p1, p2 in zip(pools_1, pools_2)]
 
     def get_exchange(self, identifier, uniswap_version=2):
         token_info = self.get_token_info(identifier)
@@ -136,89 +247,189 @@ class AssetRegister:
         else:
             return None
 
-    def calculate_price_history_in_eth(self, identifier, clear_existing=False):
+    def get_price_getter(self, batch_size=BATCH_SIZE, from_logs=False):
+        # choose how prices are fetched, returning the number of slots to price per
+        # step along with a function get_prices(identifier, blocks), which retries
+        # failed requests
+        if from_logs:
+            return LOG_STEP, retry(self.get_prices_in_eth_from_logs)
+
+        # each batch holds the four pool balance requests for every block in a step
+        step = max(1, batch_size // 4) if batch_size else 1
+        return step, retry(lambda identifier, blocks:
+                           self.get_prices_in_eth(identifier, blocks, batch_size))
+
+    def get_pools_getter(self, batch_size=BATCH_SIZE, from_logs=False):
+        # as get_price_getter, but for get_pools_in_eth
+        if from_logs:
+            return LOG_STEP, retry(self.get_pools_in_eth_from_logs)
+
+        step = max(1, batch_size // 4) if batch_size else 1
+        return step, retry(lambda identifier, blocks:
+                           self.get_pools_in_eth(identifier, blocks, batch_size))
+
+    def find_start_index(self, identifier, step, get_prices):
+        # find the first slot after the exchanges were deployed which has a price
+        b = self.blocktimes
+        deploy_num = self.get_deploy_block(identifier)
+        start_ind = next(i for i, n in enumerate(b.block_nums) if n > deploy_num)
+        for i in range(start_ind, len(b.block_nums), step):
+            blocks = b.block_nums[i:i+step]
+            found = [j for j, p in enumerate(get_prices(identifier, blocks)) if p]
+            start_ind = i + (found[0] if found else len(blocks) - 1)
+            if found:
+                break
+        return start_ind
+
+    def calculate_price_history_in_eth(self, identifier, clear_existing=False,
+                                       batch_size=BATCH_SIZE, from_logs=False,
+                                       checkpoint_slots=CHECKPOINT_SLOTS,
+                                       checkpoint_interval=CHECKPOINT_INTERVAL):
+        for _ in self.iter_calculated_prices(identifier, clear_existing, batch_size,
+                                             from_logs, checkpoint_slots,
+                                             checkpoint_interval):
+            pass
+
+    def iter_calculated_prices(self, identifier, clear_existing=False,
+                               batch_size=BATCH_SIZE, from_logs=False,
+                               checkpoint_slots=CHECKPOINT_SLOTS,
+                               checkpoint_interval=CHECKPOINT_INTERVAL):
+        # generator which extends a token's price history as
+        # calculate_price_history_in_eth does, yielding (slot index, prices) for each
+        # step as soon as it has been added to the history
         token_info = self.get_token_info(identifier)
         symbol, address = token_info['symbol'], token_info['address']
+        filename = self.price_filename(address)
         b = self.blocktimes
 
         # check if we already have a saved price history
+        existing = None
         if address in self.price_histories:
             if clear_existing:
                 self.price_histories.pop(address)
             else:
-                start_ind = self.price_histories[address]['start_index']
-                prices = self.price_histories[address]['prices']
-                continue_from = start_ind + len(prices)
+                existing = self.price_histories[address]
+                start_ind = existing['start_index']
+                continue_from = start_ind + len(existing['prices'])
+
+        step, get_prices = self.get_price_getter(batch_size, from_logs)
 
         # if starting fresh, identify first available block after exchange was deployed
-        if address not in self.price_histories:
-            deploy_num = self.get_deploy_block(identifier)
-            start_ind = next(i for i, n in enumerate(b.block_nums) if n > deploy_num)
-            for i in range(start_ind, len(b.block_nums)):
-                start_ind = i
-                price = self.get_price_in_eth(identifier, block=b.block_nums[i])
-                if price:
-                    break
+        if existing is None:
+            with metrics.stage('start_search', token=symbol):
+                start_ind = self.find_start_index(identifier, step, get_prices)
             continue_from = start_ind
-            prices = []
+
+        # the history is saved to disk as it grows, so a restart can resume from it.
+        # Once saved, prices are dropped from memory and the register's history is
+        # the saved one, so it may be behind by a checkpoint until the end. Only
+        # with checkpoints disabled is the whole history kept in memory
+        prices = []
+        history = {'symbol':symbol, 'address':address, 'start_index':start_ind,
+                   'prices':prices}
+        checkpointer = Checkpointer(filename, checkpoint_slots, checkpoint_interval)
+        if existing is not None and (checkpoint_slots or checkpoint_interval) and \
+           saved_length(filename, start_ind) == len(existing['prices']):
+            checkpointer.resume(len(existing['prices']))
+        else:
+            if existing is not None:
+                prices += list(existing['prices'])
+            self.price_histories[address] = history
 
         start_time = time.time() # for reporting progress
         last_update = 0          #  "      "        "
-        for i in range(continue_from, len(b.block_nums)):
-            price = self.get_price_in_eth(identifier, block=b.block_nums[i])
-            if not price:
-                price = 0
-            prices.append(price)
-
-            t = time.time()
-            if t - last_update > 0.2:
-                prog = progress_string(i+1-start_ind, len(b.block_nums)-start_ind, start_time)
-                print(prog, end='\r')
-                last_update = t
-
-        #elapsed = time.strftime("%H:%M:%S", time.gmtime(time.time() - start_time))
-        if last_update > 0:
-            print(' '*len(prog), end='\r')
-
-        self.price_histories[address] = {'symbol':symbol,'address':address,
-                                         'start_index':start_ind, 'prices':prices}
+        try:
+            with metrics.stage('pricing', token=symbol):
+                for i in range(continue_from, len(b.block_nums), step):
+                    blocks = b.block_nums[i:i+step]
+                    new_prices = [price if price else 0
+                                  for price in get_prices(identifier, blocks)]
+                    prices += new_prices
+                    if checkpointer.update(history):
+                        self.price_histories[address] = checkpointer.release(history)
+
+                    t = time.time()
+                    if t - last_update > 0.2:
+                        prog = progress_string(i+len(blocks)-start_ind,
+                                               len(b.block_nums)-start_ind, start_time)
+                        print(prog, end='\r')
+                        last_update = t
+
+                    yield i, new_prices
+        finally:
+            # also reached when the caller stops iterating early, keeping what was done
+            #elapsed = time.strftime("%H:%M:%S", time.gmtime(time.time() - start_time))
+            if last_update > 0:
+                print(' '*len(prog), end='\r')
+
+            if checkpointer.update(history, force=True):
+                self.price_histories[address] = checkpointer.release(history)
 
     def get_price_time_series(self, identifiers=None):
+        # prices of the given tokens (all with price histories by default) as a
+        # PriceMatrix aligned on the blocktimes slots
+        return PriceMatrix.from_histories(self.blocktimes,
+                                          self.select_price_histories(identifiers))
+
+    def stream_price_time_series(self, identifiers=None, chunk_size=READ_CHUNK):
+        # get_price_time_series as a sequence of PriceMatrix of up to chunk_size rows,
+        # so that only a chunk of each (memory mapped) history is read at a time
+        histories = self.select_price_histories(identifiers)
+        start_ind = min(h['start_index'] for h in histories)
+        end_ind = max(h['start_index'] + len(h['prices']) for h in histories)
+        for i in range(start_ind, end_ind, chunk_size):
+            yield PriceMatrix.from_histories(self.blocktimes, histories, i,
+                                             min(i + chunk_size, end_ind))
+
+    def select_price_histories(self, identifiers=None):
         if not identifiers:
             identifiers = self.price_histories.keys()
 
-        start_ind = min(v['start_index'] for _, v in self.price_histories.items()
-                        if v['symbol'] in identifiers or v['address'] in identifiers)
-
-        result  = {'time':self.blocktimes.datetimes[start_ind:]}
-
-        for identifier in identifiers:
-            token_info = self.get_token_info(identifier)
-            symbol, address = token_info['symbol'], token_info['address']
+        return [self.price_histories[self.get_token_info(identifier)['address']]
+                for identifier in identifiers]
+
+    def stream_price_history(self, identifier, chunk_size=None, calculate=False,
+                             **kwargs):
+        # a token's price history as (datetime, block, price) records, or with
+        # chunk_size as (times, blocks, prices) arrays of chunk_size slots, read from
+        # the stored history a piece at a time rather than all at once. With
+        # calculate set, the slots calculated after it follow as each step is done,
+        # with kwargs passed on to iter_calculated_prices
+        address = self.get_token_info(identifier)['address']
+
+        def pieces():
+            history = self.price_histories.get(address)
+            if history and not kwargs.get('clear_existing'):
+                yield from history_pieces(history)
+            if calculate:
+                yield from self.iter_calculated_prices(identifier, **kwargs)
+
+        if chunk_size:
+            return stream_chunks(self.blocktimes, pieces(), chunk_size)
+        return stream_records(self.blocktimes, pieces())
 
-            diff = self.price_histories[address]['start_index'] - start_ind
-            if diff:
-                result[symbol] = [None] * diff + self.price_histories[address]['prices']
-            else:
-                result[symbol] = self.price_histories[address]['prices']
+    def save_price_history(self, identifier):
+        token_info = self.get_token_info(identifier)
+        address = token_info['address']
 
-        return result
+        save_prices(self.price_filename(address), self.price_histories[address])
 
-    def save_price_history(self, identifier):
+    def export_price_history_json(self, identifier, filename=None):
         token_info = self.get_token_info(identifier)
-        symbol, address = token_info['symbol'], token_info['address']
+        address = token_info['address']
 
-        # with open(DATA_DIR + address.lower() + '.json', 'w') as f:
-        #     fjson.dump(self.price_histories[address], f,
-        #                float_format=FLOAT_FORMAT)#, separators=(',',':'))
+        if not filename:
+            filename = self.price_filename(address, '.json')
+        print(f"writing price history to {filename}")
+        export_json(filename, self.price_histories[address])
 
-        with open(DATA_DIR + address.lower() + '.json', 'w') as f:
-            data = fjson.dumps(self.price_histories[address],
-                               float_format=FLOAT_FORMAT)
-        # reduce JSON size by removing spaces
-            data = data.replace(': ', ':').replace(', ', ',')
-            f.write(data)
 
+def combine_pools(pool_A1, pool_B1, pool_A2, pool_B2):
+    # price of token A in terms of token B from the combined V1 and V2 pools
+    if pool_A1 + pool_A2 == 0:
+        return None
+    else:
+        return (pool_B1 + pool_B2) / (pool_A1 + pool_A2)
 
 def reweight_pools(pool_A, eth_A, pool_B, eth_B):
     if pool_A == 0 or eth_A == 0 or pool_B == 0 or eth_B == 0:
@@ -230,8 +441,10 @@ def reweight_pools(pool_A, eth_A, pool_B, eth_B):
     else:
         return pool_A, eth_A / B_price
 
+@lru_cache(maxsize=None)
 def get_abi(token_address):
-    # check whether we have a specific abi for this address, else use ERC-20
+    # check whether we have a specific abi for this address, else use ERC-20.
+    # The result is shared between callers, so it must not be modified
     try:
         with open(ABI_DIR + token_address.lower() + '.json') as f:
             abi = json.load(f)
@@ -240,23 +453,75 @@ def get_abi(token_address):
             abi = json.load(f)
     return abi
 
+_contracts = {}
+
+def get_contract(web3, address, abi):
+    # contract objects are reused, since building one processes the whole ABI
+    key = (id(web3), address, id(abi))
+    if key not in _contracts:
+        _contracts[key] = web3.eth.contract(address=address, abi=abi)
+    return _contracts[key]
+
+def replay_events(events, blocks, state, apply):
+    # step through events in order of occurrence, updating state with apply(state,
+    # event), and return the state as it stood at the end of each ascending block
+    states = []
+    events = iter(events)
+    event = next(events, None)
+    for block in blocks:
+        while event and event.blockNumber <= block:
+            state = apply(state, event)
+            event = next(events, None)
+        states.append(state)
+    return states
+
 class UniswapV1Exchange:
-    def __init__(self, web3, token_address):
+    def __init__(self, web3, token_address, metadata=None):
+        # metadata, as saved from a previous instance, saves looking it up again
         self.web3 = web3
-        factory = web3.eth.contract(address=UNISWAP_V1_FAC_ADR,
-                                    abi=UNISWAP_V1_FAC_ABI)
+        if metadata is None:
+            metadata = self.find_metadata(web3, token_address)
+        self.metadata = metadata
+        exchange_address = metadata['address']
+        self.contract = get_contract(web3, exchange_address, UNISWAP_V1_EXC_ABI)
+        self.token_contract = get_contract(web3, token_address, get_abi(token_address))
+        self.token_decimals = metadata['token_decimals']
+        self.deploy_block = metadata['deploy_block']
+
+    @staticmethod
+    def find_metadata(web3, token_address, from_block=UNISWAP_V1_DEPLOY_BLOCK):
+        # a missing exchange (at the zero address) is given the block it was looked
+        # for at as its deploy block, and the search for it is left out
+        factory = get_contract(web3, UNISWAP_V1_FAC_ADR, UNISWAP_V1_FAC_ABI)
         exchange_address = factory.functions \
                                   .getExchange(token_address).call()
-        self.contract = web3.eth.contract(address=exchange_address,
-                                          abi=UNISWAP_V1_EXC_ABI)
-        abi = get_abi(token_address)
-        self.token_contract = web3.eth.contract(address=token_address, abi=abi)
-        self.token_decimals = self.token_contract.functions.decimals().call()
-
-        func = lambda k: web3.eth.getCode(exchange_address, block_identifier=k)
-        self.deploy_block = find_first_change(
-            NOCODE, UNISWAP_V1_DEPLOY_BLOCK, web3.eth.blockNumber, func
-        )
+        token_contract = get_contract(web3, token_address, get_abi(token_address))
+        token_decimals = token_contract.functions.decimals().call()
+
+        deploy_block = web3.eth.blockNumber
+        if int(exchange_address, 16):
+            func = lambda k: web3.eth.getCode(exchange_address, block_identifier=k)
+            with metrics.stage('deploy_block_search', exchange='v1'):
+                deploy_block = find_first_change(NOCODE, from_block, deploy_block, func)
+        return {'address': exchange_address, 'token_decimals': token_decimals,
+                'deploy_block': deploy_block}
+
+    @staticmethod
+    def check_metadata(web3, token_address, metadata):
+        # metadata, looked up again if there was none, or if the exchange was
+        # missing and has since been created (after the block it was looked for at)
+        if metadata is None:
+            return UniswapV1Exchange.find_metadata(web3, token_address)
+        if int(metadata['address'], 16):
+            return metadata
+        factory = get_contract(web3, UNISWAP_V1_FAC_ADR, UNISWAP_V1_FAC_ABI)
+        if not int(factory.functions.getExchange(token_address).call(), 16):
+            return metadata
+        return UniswapV1Exchange.find_metadata(web3, token_address,
+                                               metadata['deploy_block'])
+
+    def exists(self):
+        return int(self.metadata['address'], 16) != 0
 
     def get_ether_balance(self, block='latest'):
         raw = self.web3.eth.getBalance(self.contract.address,block)
@@ -268,37 +533,111 @@ class UniswapV1Exchange:
         return raw * 10 ** -self.token_decimals
 
     def get_pools(self, block='latest'):
-        if isinstance(block, int) and block < self.deploy_block:
+        if not self.exists() or isinstance(block, int) and block < self.deploy_block:
             return 0, 0
         else:
             return self.get_erc20_balance(block), self.get_ether_balance(block)
 
+    def get_pools_requests(self, block='latest'):
+        # JSON-RPC requests for get_pools, to be sent with rpc.batch_request. A missing
+        # exchange has no pools, rather than the balances of the zero address
+        if not self.exists() or isinstance(block, int) and block < self.deploy_block:
+            return []
+        return [eth_call(self.token_contract, 'balanceOf', [self.contract.address], block),
+                ('eth_getBalance', [self.contract.address, block_param(block)])]
+
+    def decode_pools(self, results):
+        # convert the results of the get_pools_requests requests into pools
+        if not results:
+            return 0, 0
+        erc20_raw, ether_raw = (int(r, 16) for r in results)
+        return erc20_raw * 10 ** -self.token_decimals, ether_raw * 10 ** -18
+
+    def get_pools_history(self, blocks, chunk_size=LOG_CHUNK_SIZE):
+        # reconstruct get_pools for an ascending list of blocks: the balances are read
+        # at the first block and then updated from the trade and liquidity events.
+        # V1 exchanges keep no reserves, so transfers straight to one (which aren't
+        # events of the exchange) are only picked up by the next pass
+        if not self.exists():
+            return [(0, 0)] * len(blocks)
+        results = batch_request(self.web3, self.get_pools_requests(blocks[0]))
+        initial = tuple(int(r, 16) for r in results) if results else (0, 0)
+
+        events = {}
+        for name in V1_POOL_EVENTS:
+            event = self.contract.events[name]()
+            events[event_abi_to_log_topic(event.abi)] = event
+        from_block = max(blocks[0] + 1, self.deploy_block)
+        logs = get_logs(self.web3, self.contract.address,
+                        [[encode_hex(topic) for topic in events]],
+                        from_block, blocks[-1], chunk_size)
+
+        def apply(state, log):
+            erc20_raw, ether_raw = state
+            event = events[bytes(log.topics[0])].processLog(log)
+            (eth_arg, eth_sign), (token_arg, token_sign) = V1_POOL_EVENTS[event.event]
+            return (erc20_raw + token_sign * event.args[token_arg],
+                    ether_raw + eth_sign * event.args[eth_arg])
+
+        return [(erc20_raw * 10 ** -self.token_decimals, ether_raw * 10 ** -18)
+                for erc20_raw, ether_raw in replay_events(logs, blocks, initial, apply)]
+
 class UniswapV2Exchange:
-    def __init__(self, web3, token_A_address, token_B_address=WETH_ADR):
+    def __init__(self, web3, token_A_address, token_B_address=WETH_ADR, metadata=None):
+        # metadata, as saved from a previous instance, saves looking it up again
         self.web3 = web3
-        factory = web3.eth.contract(address=UNISWAP_V2_FAC_ADR,
-                                    abi=UNISWAP_V2_FAC_ABI)
-        self.address = factory.functions.getPair(token_A_address,
-                                                 token_B_address).call()
-        self.contract = web3.eth.contract(address=self.address,
-                                          abi=UNISWAP_V2_EXC_ABI)
-
-        token_A_abi = get_abi(token_A_address)
-        self.token_A_contract = web3.eth.contract(address=token_A_address,
-                                                  abi=token_A_abi)
-        self.token_A_decimals = self.token_A_contract \
-                                    .functions.decimals().call()
-
-        token_B_abi = get_abi(token_B_address)
-        self.token_B_contract = web3.eth.contract(address=token_B_address,
-                                                  abi=token_B_abi)
-        self.token_B_decimals = self.token_B_contract \
-                                    .functions.decimals().call()
-
-        func = lambda k: web3.eth.getCode(self.address, block_identifier=k)
-        self.deploy_block = find_first_change(
-            NOCODE, UNISWAP_V2_DEPLOY_BLOCK, web3.eth.blockNumber, func
-        )
+        if metadata is None:
+            metadata = self.find_metadata(web3, token_A_address, token_B_address)
+        self.metadata = metadata
+        self.address = metadata['address']
+        self.contract = get_contract(web3, self.address, UNISWAP_V2_EXC_ABI)
+
+        self.token_A_contract = get_contract(web3, token_A_address,
+                                             get_abi(token_A_address))
+        self.token_A_decimals = metadata['token_A_decimals']
+        self.token_B_contract = get_contract(web3, token_B_address,
+                                             get_abi(token_B_address))
+        self.token_B_decimals = metadata['token_B_decimals']
+        self.deploy_block = metadata['deploy_block']
+
+    @staticmethod
+    def find_metadata(web3, token_A_address, token_B_address=WETH_ADR,
+                      from_block=UNISWAP_V2_DEPLOY_BLOCK):
+        # as UniswapV1Exchange.find_metadata
+        factory = get_contract(web3, UNISWAP_V2_FAC_ADR, UNISWAP_V2_FAC_ABI)
+        address = factory.functions.getPair(token_A_address,
+                                            token_B_address).call()
+
+        token_A_contract = get_contract(web3, token_A_address,
+                                        get_abi(token_A_address))
+        token_A_decimals = token_A_contract.functions.decimals().call()
+        token_B_contract = get_contract(web3, token_B_address,
+                                        get_abi(token_B_address))
+        token_B_decimals = token_B_contract.functions.decimals().call()
+
+        deploy_block = web3.eth.blockNumber
+        if int(address, 16):
+            func = lambda k: web3.eth.getCode(address, block_identifier=k)
+            with metrics.stage('deploy_block_search', exchange='v2'):
+                deploy_block = find_first_change(NOCODE, from_block, deploy_block, func)
+        return {'address': address, 'token_A_decimals': token_A_decimals,
+                'token_B_decimals': token_B_decimals, 'deploy_block': deploy_block}
+
+    @staticmethod
+    def check_metadata(web3, token_A_address, metadata, token_B_address=WETH_ADR):
+        # as UniswapV1Exchange.check_metadata
+        if metadata is None:
+            return UniswapV2Exchange.find_metadata(web3, token_A_address, token_B_address)
+        if int(metadata['address'], 16):
+            return metadata
+        factory = get_contract(web3, UNISWAP_V2_FAC_ADR, UNISWAP_V2_FAC_ABI)
+        if not int(factory.functions.getPair(token_A_address, token_B_address).call(), 16):
+            return metadata
+        return UniswapV2Exchange.find_metadata(web3, token_A_address, token_B_address,
+                                               metadata['deploy_block'])
+
+    def exists(self):
+        return int(self.metadata['address'], 16) != 0
 
     def get_token_A_balance(self, block='latest'):
         raw = self.token_A_contract.functions.balanceOf(self.address)  \
@@ -312,7 +651,56 @@ class UniswapV2Exchange:
         return raw * 10 ** -self.token_B_decimals
 
     def get_pools(self, block='latest'):
-        if isinstance(block, int) and block < self.deploy_block:
+        if not self.exists() or isinstance(block, int) and block < self.deploy_block:
             return 0, 0
         else:
             return self.get_token_A_balance(block), self.get_token_B_balance(block)
+
+    def get_pools_requests(self, block='latest'):
+        # JSON-RPC requests for get_pools, to be sent with rpc.batch_request. A missing
+        # exchange has no pools, rather than the balances of the zero address
+        if not self.exists() or isinstance(block, int) and block < self.deploy_block:
+            return []
+        return [eth_call(self.token_A_contract, 'balanceOf', [self.address], block),
+                eth_call(self.token_B_contract, 'balanceOf', [self.address], block)]
+
+    def decode_pools(self, results):
+        # convert the results of the get_pools_requests requests into pools
+        if not results:
+            return 0, 0
+        token_A_raw, token_B_raw = (int(r, 16) for r in results)
+        return token_A_raw * 10 ** -self.token_A_decimals, \
+               token_B_raw * 10 ** -self.token_B_decimals
+
+    def get_pools_history(self, blocks, chunk_size=LOG_CHUNK_SIZE):
+        # reconstruct get_pools for an ascending list of blocks from the reserves: those
+        # at the first block, and then those of each Sync event. The reserves only
+        # differ from the balances get_pools reads by tokens sent straight to the pair
+        # (which anyone can skim), so pools of a pass are consistent with each other,
+        # if not always equal to the polled ones
+        if not self.exists():
+            return [(0, 0)] * len(blocks)
+
+        # reserves are ordered by token address, token A may be either of them
+        A_first = int(self.token_A_contract.address, 16) < \
+                  int(self.token_B_contract.address, 16)
+        initial = (0, 0)
+        if blocks[0] >= self.deploy_block:
+            result = batch_request(self.web3, [eth_call(self.contract, 'getReserves', [],
+                                                        blocks[0])])[0]
+            reserve0, reserve1 = int(result[2:66], 16), int(result[66:130], 16)
+            initial = (reserve0, reserve1) if A_first else (reserve1, reserve0)
+
+        event = self.contract.events.Sync()
+        from_block = max(blocks[0] + 1, self.deploy_block)
+        topic = encode_hex(event_abi_to_log_topic(event.abi))
+        logs = get_logs(self.web3, self.address, [topic], from_block, blocks[-1], chunk_size)
+
+        def apply(state, log):
+            args = event.processLog(log).args
+            reserve0, reserve1 = args.reserve0, args.reserve1
+            return (reserve0, reserve1) if A_first else (reserve1, reserve0)
+
+        return [(token_A_raw * 10 ** -self.token_A_decimals,
+                 token_B_raw * 10 ** -self.token_B_decimals)
+                for token_A_raw, token_B_raw in replay_events(logs, blocks, initial, apply)]
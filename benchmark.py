@@ -0,0 +1,253 @@
+import io
+import atexit
+import os
+import json
+import time
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+import numpy as np
+import yaml
+
+import mocknode
+from assetregister import AssetRegister
+from blocktimes import Blocktimes, DELTA
+from priceengine import AsyncPriceEngine
+from rpc import BATCH_SIZE
+from shardengine import ShardedPriceEngine
+
+# times the price pipeline end to end against a local mocknode.MockNode: generating
+# the Blocktimes sequence, adding the tokens to an AssetRegister and calculating
+# their price histories. Nothing is read from or written to data/, so every run
+# starts cold. Save the results of one run with --output and pass them to a later
+# run with --baseline to compare the two.
+# Peak memory is the process's maximum resident set size, which only ever grows,
+# unless trace_memory is set, in which case it is the peak of the memory allocated
+# by Python during each stage. Tracing allocations slows everything down though
+
+PORT = 8546
+
+def run_stage(node, name, slots, func):
+    # call func, returning its result along with its statistics
+    calls = node.calls
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    start = time.time()
+    with redirect_stdout(io.StringIO()):
+        result = func()
+    elapsed = time.time() - start
+    if tracemalloc.is_tracing():
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    else:
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    stats = {'stage': name, 'seconds': elapsed, 'rpc_calls': node.calls - calls,
+             'peak_memory': peak_memory}
+    set_slots(stats, slots)
+    return result, stats
+
+def set_slots(stats, slots):
+    stats['slots'] = slots
+    if slots:
+        stats['calls_per_slot'] = stats['rpc_calls'] / slots
+        stats['slots_per_second'] = slots / stats['seconds']
+
+def run(slots=1000, delta=DELTA, latency=0, workers=1, batch_size=BATCH_SIZE,
+        from_logs=False, engine=False, trace_memory=False):
+    node = mocknode.MockNode(latency=latency)
+    server = mocknode.serve(node, PORT)
+    node_url = f"http://127.0.0.1:{PORT}"
+    head_ts = node.timestamp(node.head)
+    start_ts = (head_ts - slots * delta) // delta * delta
+
+    results = []
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            blocktimes, stats = run_stage(node, 'blocktimes', None, lambda: Blocktimes(
+                start_ts=start_ts, delta=delta, node_url=node_url, workers=workers,
+                timestamps_filename=None, rpc_cache_filename=None))
+            set_slots(stats, len(blocktimes.block_nums))
+            results.append(stats)
+
+            ar = make_register(tmp, node_url, blocktimes)
+            _, stats = run_stage(node, 'add_assets', None, ar.add_all_assets)
+            results.append(stats)
+
+            total_slots = sum(len(ar.blocktimes.block_nums) -
+                              next(i for i, n in enumerate(ar.blocktimes.block_nums)
+                                   if n > ar.get_deploy_block(symbol))
+                              for symbol in ar.token_lookup)
+            if engine:
+                calculate = lambda: AsyncPriceEngine(
+                    ar, batch_size=batch_size, from_logs=from_logs, checkpoint_slots=None,
+                    checkpoint_interval=None).run(clear_existing=True)
+            else:
+                calculate = lambda: [ar.calculate_price_history_in_eth(
+                    symbol, clear_existing=True, batch_size=batch_size,
+                    from_logs=from_logs, checkpoint_slots=None, checkpoint_interval=None)
+                    for symbol in ar.token_lookup]
+            _, stats = run_stage(node, 'prices', total_slots, calculate)
+            results.append(stats)
+    finally:
+        tracemalloc.stop()
+        server.shutdown()
+    return results
+
+def make_register(tmp, node_url, blocktimes, rpc_cache_filename=None):
+    # AssetRegister for the mock node's tokens, with its files in the directory tmp
+    tokens_filename = os.path.join(tmp, 'tokens.yaml')
+    with open(tokens_filename, 'w') as f:
+        yaml.dump({symbol: {'name': symbol, 'address': address}
+                   for symbol, (address, _) in mocknode.TOKENS.items()}, f)
+    blocktimes_filename = os.path.join(tmp, 'blocktimes.json')
+    blocktimes.save(blocktimes_filename)
+    return AssetRegister(node_url, tokens_filename, blocktimes_filename,
+                         exchanges_filename=os.path.join(tmp, 'exchanges.json'),
+                         rpc_cache_filename=rpc_cache_filename)
+
+def check_from_logs(slots=1000, delta=DELTA, batch_size=BATCH_SIZE):
+    # price every token of the mock node both by polling the pools at each slot and
+    # from the exchange events, returning the largest relative difference between
+    # the two for each token
+    node = mocknode.MockNode()
+    server = mocknode.serve(node, PORT)
+    node_url = f"http://127.0.0.1:{PORT}"
+    start_ts = (node.timestamp(node.head) - slots * delta) // delta * delta
+    differences = {}
+    try:
+        with tempfile.TemporaryDirectory() as tmp, redirect_stdout(io.StringIO()):
+            blocktimes = Blocktimes(start_ts=start_ts, delta=delta, node_url=node_url,
+                                    timestamps_filename=None, rpc_cache_filename=None)
+            ar = make_register(tmp, node_url, blocktimes)
+            ar.add_all_assets()
+            block_nums = ar.blocktimes.block_nums
+            for symbol in ar.token_lookup:
+                prices = []
+                for from_logs in (False, True):
+                    step, get_prices = ar.get_price_getter(batch_size, from_logs)
+                    prices.append(np.array(
+                        [p or 0 for i in range(0, len(block_nums), step)
+                         for p in get_prices(symbol, block_nums[i:i+step])], dtype=float))
+                polled, logged = prices
+                scale = np.maximum(np.abs(polled), np.finfo(float).tiny)
+                differences[symbol] = float(np.max(np.abs(logged - polled) / scale))
+    finally:
+        server.shutdown()
+    return differences
+
+def check_shards(slots=1000, delta=DELTA, workers=6, batch_size=BATCH_SIZE,
+                 from_logs=True):
+    # calculate every token of the mock node with a ShardedPriceEngine, with the
+    # register's responses cached as they are by default, and return whether each
+    # history is the same as the one calculated by polling in the main process. The
+    # engine saves the histories under data/, so this runs in a temporary directory
+    # (with a link to the ABIs)
+    node = mocknode.MockNode()
+    server = mocknode.serve(node, PORT)
+    node_url = f"http://127.0.0.1:{PORT}"
+    start_ts = (node.timestamp(node.head) - slots * delta) // delta * delta
+    cwd = os.getcwd()
+    matches = {}
+    try:
+        with tempfile.TemporaryDirectory() as tmp, redirect_stdout(io.StringIO()):
+            os.chdir(tmp)
+            os.makedirs('data')
+            os.symlink(os.path.join(cwd, 'abi'), 'abi')
+            blocktimes = Blocktimes(start_ts=start_ts, delta=delta, node_url=node_url,
+                                    timestamps_filename=None, rpc_cache_filename=None)
+            ar = make_register(tmp, node_url, blocktimes,
+                               os.path.join(tmp, 'rpccache.sqlite'))
+            ar.add_all_assets()
+            engine = ShardedPriceEngine(ar, workers, shard_slots=max(slots // workers, 1),
+                                        shard_dir=os.path.join(tmp, 'shards'),
+                                        batch_size=batch_size, from_logs=from_logs)
+            for symbol in ar.token_lookup:
+                address = ar.get_token_info(symbol)['address']
+                engine.run(symbol, clear_existing=True)
+                sharded = ar.price_histories[address]
+                ar.calculate_price_history_in_eth(symbol, clear_existing=True,
+                                                  batch_size=batch_size,
+                                                  checkpoint_slots=None,
+                                                  checkpoint_interval=None)
+                polled = ar.price_histories[address]
+                matches[symbol] = sharded['start_index'] == polled['start_index'] and \
+                                  np.array_equal(sharded['prices'], polled['prices'])
+            # the cache file goes with the directory, so isn't committed at exit
+            cache = ar.web3.provider.cache
+            atexit.unregister(cache.commit)
+            cache.conn.close()
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+    return matches
+
+def report(results, baseline=None):
+    baseline = {r['stage']: r for r in baseline or []}
+    print(f"{'stage':<12}{'seconds':>10}{'rpc calls':>11}{'slots':>8}"
+          f"{'calls/slot':>12}{'slots/s':>10}{'peak MB':>9}")
+    for r in results:
+        print(f"{r['stage']:<12}{r['seconds']:>10.2f}{r['rpc_calls']:>11}"
+              f"{r['slots'] or '':>8}{r.get('calls_per_slot', 0):>12.2f}"
+              f"{r.get('slots_per_second', 0):>10.1f}{r['peak_memory'] / 2**20:>9.1f}")
+        base = baseline.get(r['stage'])
+        if base:
+            print(f"{'  baseline':<12}{base['seconds'] / r['seconds']:>9.2f}x"
+                  f"{base['rpc_calls'] / max(r['rpc_calls'], 1):>10.2f}x"
+                  f"{'':>20}{'':>10}"
+                  f"{base['peak_memory'] / max(r['peak_memory'], 1):>8.2f}x")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the price pipeline '
+                                                 'against a local mock archive node')
+    parser.add_argument('--slots', type=int, default=1000,
+                        help='number of Blocktimes slots, ending at the latest block')
+    parser.add_argument('--delta', type=int, default=DELTA)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the mock node waits before each response')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='workers for Blocktimes sequence generation')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='JSON-RPC batch size, 0 to disable batching')
+    parser.add_argument('--from-logs', action='store_true',
+                        help='reconstruct pools from exchange events')
+    parser.add_argument('--engine', action='store_true',
+                        help='calculate prices with the AsyncPriceEngine')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure the peak memory allocated in each stage')
+    parser.add_argument('--output', help='file to save the results to')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with '
+                                           '(the ratios shown are baseline / this run)')
+    parser.add_argument('--check-logs', action='store_true',
+                        help='check that prices from exchange events agree with '
+                             'those polled at each slot, rather than timing anything')
+    parser.add_argument('--check-shards', action='store_true',
+                        help='check that a ShardedPriceEngine gives the same histories '
+                             'as polling, with --workers processes (and --from-logs)')
+    args = parser.parse_args()
+
+    if args.check_logs:
+        differences = check_from_logs(args.slots, args.delta, args.batch_size)
+        for symbol, difference in differences.items():
+            print(f"{symbol:<8}largest relative difference {difference:.3g}")
+        raise SystemExit(max(differences.values()) > 1e-9)
+    if args.check_shards:
+        matches = check_shards(args.slots, args.delta, max(args.workers, 2),
+                               args.batch_size, args.from_logs)
+        for symbol, match in matches.items():
+            print(f"{symbol:<8}{'same' if match else 'DIFFERENT'}")
+        raise SystemExit(not all(matches.values()))
+
+    results = run(args.slots, args.delta, args.latency, args.workers, args.batch_size,
+                  args.from_logs, args.engine, args.trace_memory)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
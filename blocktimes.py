@@ -1,25 +1,58 @@
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
 import time
 import math
 import json
 
-from web3 import Web3
+import numpy as np
 
 from utils import interp_search, progress_string
+from timestamps import TimestampStore, DEFAULT_FILENAME as TIMESTAMPS_FILENAME
+from metrics import metrics
+from pricestore import meta_filename, write_atomic
+from rpc import connect
+from rpccache import DEFAULT_FILENAME as RPC_CACHE_FILENAME
 
 # genesis timestamp is not on blockchain, this is taken from etherscan.io
 GENESIS_TS = 1438269973
 NODE_URL = "http://localhost:8545"
 DELTA = 1800 # 1800 seconds = 30 minutes
-DEFAULT_FILENAME = 'data/blocktimes.json'
+DEFAULT_FILENAME = 'data/blocktimes.bin'
+# each slot is saved as the difference between its block number and that of the
+# previous slot, along with its timestamp offset, in a raw little-endian array
+# which is read in one go, with {start_ts, delta, end_ts, length} in a JSON file
+# alongside it. Files whose names end in .json are in the original JSON format
+RECORD_DTYPE = np.dtype([('block_diff', '<i4'), ('ts_offset', '<i4')])
+SEGMENT_LENGTH = 500 # number of slots searched by each task of a parallel generation
 
 class Blocktimes:
     # object that can calculate, update, save, load and query a sequence of
     # Ethereum block numbers corresponding to equally spaced time deltas
     def __init__(
-            self, start_ts=None, delta=DELTA, node_url=NODE_URL, filename=None
+            self, start_ts=None, delta=DELTA, node_url=NODE_URL, filename=None, workers=1,
+            timestamps_filename=TIMESTAMPS_FILENAME, web3=None,
+            rpc_cache_filename=RPC_CACHE_FILENAME, end_ts=None
     ):
-        if filename:
+        # connection to the node: the given Web3 instance (shared with an
+        # AssetRegister, say), or else a new one for node_url, with historical
+        # requests cached in rpc_cache_filename
+        self.web3 = web3
+        self.rpc_cache_filename = rpc_cache_filename
+
+        # block timestamps fetched from the node, shared by all sequence generation
+        # and kept on disk in a TimestampStore (if timestamps_filename is given)
+        self.timestamp_cache = {}
+        self.timestamps_filename = timestamps_filename
+        self.timestamp_store = None
+        self._arrays = None
+
+        # the binary file the sequence was last loaded from or saved to, and the
+        # number of slots in it, so that save only has to append the slots after them
+        self.saved = (None, 0)
+        self._datetimes = None
+
+        if filename and filename.endswith('.json'):
             # restore Blocktimes object from saved JSON file
             with open(filename) as f:
                 tmp = json.load(f)
@@ -28,33 +61,68 @@ class Blocktimes:
             if 'block_nums' in tmp:
                 self.block_nums = tmp['block_nums']
             else:
-                self.block_nums = []
-                total = 0
-                for d in tmp['block_diffs']:
-                    total += d
-                    self.block_nums += [total]
+                self.block_nums = np.cumsum(tmp['block_diffs'], dtype=np.int64).tolist()
 
             self.ts_offsets = tmp['ts_offsets']
+            self.end_ts = tmp.get('end_ts')
+        elif filename:
+            self.load(filename)
         else:
             # generate new Blocktimes object based on supplied parameters
             if not start_ts:
                 start_ts = delta * (GENESIS_TS // delta + 1)
             self.start_ts = start_ts
             self.delta = delta
+            self.end_ts = end_ts # if given, the sequence stops at this time
             self.block_nums = []
             self.ts_offsets = []
 
-            self.generate_sequence(node_url)
+            with metrics.stage('blocktimes'):
+                self.generate_sequence(node_url, workers)
 
-        self.datetimes = []
-        for i, offset in enumerate(self.ts_offsets):
-            ts = self.start_ts + i * self.delta + offset
-            self.datetimes.append(datetime.fromtimestamp(ts))
+    @property
+    def datetimes(self):
+        # local datetime of the block of each slot, only made when first used
+        key = (len(self.block_nums), self.block_nums[-1] if self.block_nums else None)
+        if self._datetimes is None or self._datetimes[0] != key:
+            self._datetimes = (key, [datetime.fromtimestamp(ts)
+                                     for ts in self.timestamps().tolist()])
+        return self._datetimes[1]
 
-    def generate_sequence(self, node_url=NODE_URL):
-        web3 = Web3(Web3.HTTPProvider(node_url))
+    def get_web3(self, node_url=NODE_URL):
+        if self.web3 is not None:
+            return self.web3
+        return connect(node_url, self.rpc_cache_filename)
+
+    def get_timestamp_func(self, web3):
+        if self.timestamps_filename and self.timestamp_store is None:
+            self.timestamp_store = TimestampStore(self.timestamps_filename)
+        cache, store = self.timestamp_cache, self.timestamp_store
         def get_timestamp(block):
-            return web3.eth.getBlock(block).timestamp
+            if block not in cache:
+                ts = store.timestamp_of(block) if store is not None else None
+                if ts is None:
+                    ts = web3.eth.getBlock(block).timestamp
+                    if store is not None:
+                        store.add(block, ts)
+                cache[block] = ts
+            return cache[block]
+        return get_timestamp
+
+    def commit_timestamps(self):
+        if self.timestamp_store is not None:
+            self.timestamp_store.commit()
+
+    def last_target(self, latest_ts):
+        # time up to which the sequence can be generated
+        return latest_ts if self.end_ts is None else min(latest_ts, self.end_ts)
+
+    def generate_sequence(self, node_url=NODE_URL, workers=1):
+        if workers > 1:
+            return self.generate_sequence_parallel(node_url, workers)
+
+        web3 = self.get_web3(node_url)
+        get_timestamp = self.get_timestamp_func(web3)
 
         start_ts = self.start_ts
         delta = self.delta
@@ -62,13 +130,13 @@ class Blocktimes:
         latest_blocknum = latest_block.number
         latest_ts = latest_block.timestamp
 
-        last = start_ts + delta * ((latest_ts - start_ts) // delta)
+        last = start_ts + delta * ((self.last_target(latest_ts) - start_ts) // delta)
         sequence_length = 1 + (last - start_ts) // delta
 
         n = len(self.block_nums)
         if n > 0:
             blocknum_lims = [self.block_nums[-1], 0]
-            ts_lims = [start_ts + n * delta + self.ts_offsets[-1], 0]
+            ts_lims = [start_ts + (n - 1) * delta + self.ts_offsets[-1], 0]
         else:
             blocknum_lims = [0, 0]
             ts_lims = [GENESIS_TS, 0]
@@ -82,7 +150,8 @@ class Blocktimes:
             ts_lims[1] = latest_ts
             target = start_ts + i * delta
 
-            b, o, c = interp_search(target, blocknum_lims, ts_lims, get_timestamp)
+            b, o, c = self.search_slot(target, (blocknum_lims[0], ts_lims[0]),
+                                       (blocknum_lims[1], ts_lims[1]), get_timestamp)
 
             self.block_nums.append(b)
             self.ts_offsets.append(o)
@@ -96,25 +165,179 @@ class Blocktimes:
 
         if start_ind < sequence_length:
             print(' ' * len(prog), end='\r')
+        self.commit_timestamps()
+
+    def generate_sequence_parallel(self, node_url=NODE_URL, workers=8,
+                                   segment_length=SEGMENT_LENGTH):
+        # produces the same sequence as generate_sequence, but first searches for
+        # coarse anchor blocks every segment_length slots, then fills in the slots
+        # between each pair of anchors concurrently
+        web3 = self.get_web3(node_url)
+        get_timestamp = self.get_timestamp_func(web3)
+
+        start_ts = self.start_ts
+        delta = self.delta
+        latest_block = web3.eth.getBlock('latest')
+        latest = (latest_block.number, latest_block.timestamp)
+
+        last = start_ts + delta * ((self.last_target(latest[1]) - start_ts) // delta)
+        sequence_length = 1 + (last - start_ts) // delta
+
+        n = len(self.block_nums)
+        if n > 0:
+            lower = (self.block_nums[-1], start_ts + (n - 1) * delta + self.ts_offsets[-1])
+        else:
+            lower = (0, GENESIS_TS)
+
+        # the anchors are found in sequence, each search starting from the last
+        anchors = []
+        for i in range(n, sequence_length, segment_length):
+            target = start_ts + i * delta
+            b, o, _ = self.search_slot(target, lower, latest, get_timestamp)
+            lower = (b, target + o)
+            anchors.append((i, lower))
+
+        # each segment only searches strictly between its bounding anchors, so no
+        # two tasks can request the same block
+        def search_segment(k):
+            first, lower = anchors[k]
+            last, upper = anchors[k+1] if k + 1 < len(anchors) else (sequence_length, latest)
+            block_nums, ts_offsets = [lower[0]], [lower[1] - (start_ts + first * delta)]
+            for i in range(first + 1, last):
+                target = start_ts + i * delta
+                b, o, _ = self.search_slot(target, lower, upper, get_timestamp)
+                block_nums.append(b)
+                ts_offsets.append(o)
+                lower = (b, target + o)
+            return block_nums, ts_offsets
+
+        start_time = time.time()
+        segments = [None] * len(anchors)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(search_segment, k): k for k in range(len(anchors))}
+            for done, future in enumerate(as_completed(futures)):
+                segments[futures[future]] = future.result()
+                prog = progress_string(done, len(anchors), start_time)
+                print(prog, end='\r')
+
+        # a slot whose target falls before the timestamp of the previous slot's block
+        # (a gap of more than delta between blocks) takes the block after it, as in
+        # the sequential search
+        for block_nums, ts_offsets in segments:
+            for b, o in zip(block_nums, ts_offsets):
+                i = len(self.block_nums)
+                target = start_ts + i * delta
+                if i > 0 and target <= start_ts + (i - 1) * delta + self.ts_offsets[-1]:
+                    b = self.block_nums[-1] + 1
+                    o = get_timestamp(b) - target
+                self.block_nums.append(b)
+                self.ts_offsets.append(o)
+
+        if anchors:
+            print(' ' * len(prog), end='\r')
+        self.commit_timestamps()
+
+    def truncate(self, length):
+        # drop the slots from index length on, so that they are found again by the
+        # next generate_sequence (after a reorganisation of the chain, say)
+        self.block_nums = self.block_nums[:length]
+        self.ts_offsets = self.ts_offsets[:length]
+        saved_filename, saved = self.saved
+        self.saved = (saved_filename, min(saved, length))
+        self._arrays = None
+        self._datetimes = None
+
+    def forget_timestamps(self, block):
+        # discard the timestamps fetched for the blocks after block, so that blocks
+        # which may since have been replaced are fetched again
+        for n in [n for n in self.timestamp_cache if n > block]:
+            del self.timestamp_cache[n]
+        if self.timestamps_filename and self.timestamp_store is None:
+            self.timestamp_store = TimestampStore(self.timestamps_filename)
+        if self.timestamp_store is not None:
+            self.timestamp_store.discard_after(block)
+
+    def search_slot(self, target, lower, upper, get_timestamp):
+        # (block, offset, evaluations) of the slot at time target, searching between
+        # the (block, timestamp) bounds lower and upper. The stored timestamps narrow
+        # the search to the nearest blocks on either side of target, which answer it
+        # without fetching anything if they are adjacent, so that a sequence with a
+        # different delta over the same time needs few new timestamps
+        store = self.timestamp_store
+        if store is not None:
+            below, above = store.bounds(target)
+            if below and below[0] > lower[0]:
+                lower = below
+            # if the previous slot's block is at or after target, as when there is
+            # a gap of more than delta between blocks, the slot takes the block after
+            # it, which the search finds from the original upper bound
+            if above and lower[0] < above[0] < upper[0]:
+                upper = above
+        return interp_search(target, (lower[0], upper[0]), (lower[1], upper[1]),
+                             get_timestamp)
 
     def save(self, filename=DEFAULT_FILENAME):
-        data = self.as_dict()
-        prev = 0
-        diffs = []
+        # save to filename, in the original JSON format if its name ends in .json.
+        # Slots already saved to a binary file aren't changed, so only the new ones
+        # are appended to it
+        if filename.endswith('.json'):
+            data = self.as_dict()
+            data['block_diffs'] = np.diff(data.pop('block_nums'), prepend=0).tolist()
+            with open(filename, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            return
+
+        saved_filename, saved = self.saved
+        if saved_filename != filename or not os.path.exists(filename):
+            saved = 0
+        records = np.zeros(len(self.block_nums) - saved, dtype=RECORD_DTYPE)
+        records['block_diff'] = np.diff(self.block_nums[max(saved - 1, 0):],
+                                        prepend=[] if saved else [0])
+        records['ts_offset'] = self.ts_offsets[saved:]
 
-        for b in data['block_nums']:
-            diffs += [b - prev]
-            prev = b
+        # as with price histories, the metadata is only updated once the records are
+        # on disk, and anything beyond its length is discarded before appending
+        if saved:
+            with open(filename, 'r+b') as f:
+                f.truncate(saved * RECORD_DTYPE.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(records.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            write_atomic(filename, records.tobytes(), 'wb')
+        meta = {'start_ts': self.start_ts, 'delta': self.delta,
+                'length': len(self.block_nums)}
+        if self.end_ts is not None:
+            meta['end_ts'] = self.end_ts
+        write_atomic(meta_filename(filename), json.dumps(meta))
+        self.saved = (filename, len(self.block_nums))
 
-        data.pop('block_nums')
-        data['block_diffs'] = diffs
+    def load(self, filename=DEFAULT_FILENAME):
+        with open(meta_filename(filename)) as f:
+            meta = json.load(f)
+        self.start_ts = meta['start_ts']
+        self.delta = meta['delta']
+        self.end_ts = meta.get('end_ts')
 
-        with open(filename, 'w') as f:
-            json.dump(data, f, separators=(',', ':'))
+        records = np.fromfile(filename, dtype=RECORD_DTYPE, count=meta['length'])
+        block_nums = np.cumsum(records['block_diff'], dtype=np.int64)
+        ts_offsets = records['ts_offset'].astype(np.int64)
+        self.block_nums = block_nums.tolist()
+        self.ts_offsets = ts_offsets.tolist()
+        self.saved = (filename, len(self.block_nums))
+
+        # the arrays are already at hand, so there's no need to rebuild them
+        key = (len(self.block_nums), self.block_nums[-1] if self.block_nums else None)
+        timestamps = self.start_ts + self.delta * np.arange(len(block_nums)) + ts_offsets
+        self._arrays = (key, block_nums, timestamps)
 
     def as_dict(self):
-        return {'start_ts':self.start_ts, 'delta':self.delta, 'block_nums':self.block_nums,
+        data = {'start_ts':self.start_ts, 'delta':self.delta, 'block_nums':self.block_nums,
                 'ts_offsets':self.ts_offsets}
+        if self.end_ts is not None:
+            data['end_ts'] = self.end_ts
+        return data
 
     def print_latest(self):
         N = len(self.block_nums)
@@ -122,24 +345,68 @@ class Blocktimes:
         dt = datetime.utcfromtimestamp(last_period)
         print(f"latest dt: {dt}, blocknum: {self.block_nums[-1]}")
 
-    def update(self):
+    def update(self, node_url=NODE_URL, workers=1):
         # extend sequence of block numbers up to the present
-        self.generate_sequence()
+        with metrics.stage('blocktimes'):
+            self.generate_sequence(node_url, workers)
         self.print_latest()
 
+    def arrays(self):
+        # block_nums and slot timestamps as int64 arrays for vectorized queries,
+        # rebuilt whenever the sequence has changed
+        key = (len(self.block_nums), self.block_nums[-1] if self.block_nums else None)
+        if self._arrays is None or self._arrays[0] != key:
+            block_nums = np.array(self.block_nums, dtype=np.int64)
+            timestamps = self.start_ts + self.delta * np.arange(len(block_nums)) + \
+                         np.array(self.ts_offsets, dtype=np.int64)
+            self._arrays = (key, block_nums, timestamps)
+        return self._arrays[1:]
+
+    def timestamps(self, start=0, end=None):
+        # array of the block timestamps of slots start to end
+        return self.arrays()[1][start:end]
+
     def lookup(self, target):
-        if not (isinstance(target, list) or isinstance(target, tuple)):
+        # block number and block timestamp of the slot at timestamp target, which
+        # may also be a list, tuple or array of timestamps
+        if not isinstance(target, (list, tuple, np.ndarray)):
             i = round((target - self.start_ts) / self.delta)
             return self.block_nums[i], self.start_ts + i * self.delta + self.ts_offsets[i]
 
-        block_nums = []
-        timestamps = []
-        for t in target:
-            i = round((t - self.start_ts) / self.delta)
-            block_nums.append(self.block_nums[i])
-            timestamps.append(self.start_ts + i * self.delta + self.ts_offsets[i])
+        block_nums, timestamps = self.arrays()
+        # np.rint rounds halves to even, in the same way as round
+        i = np.rint((np.asarray(target) - self.start_ts) / self.delta).astype(np.int64)
+        if i.size and (i.min() < 0 or i.max() >= len(block_nums)):
+            raise IndexError('timestamp outside of the blocktimes sequence')
+
+        if isinstance(target, np.ndarray):
+            return block_nums[i], timestamps[i]
+        return block_nums[i].tolist(), timestamps[i].tolist()
+
+    def lookup_block(self, block):
+        # reverse lookup: index and block timestamp of the latest slot at or before
+        # block (an index of -1 means block precedes the sequence). block may be a
+        # number or an array of numbers
+        block_nums, timestamps = self.arrays()
+        i = np.searchsorted(block_nums, block, side='right') - 1
+        ts = np.where(i >= 0, timestamps[np.maximum(i, 0)], -1)
+        if np.ndim(i) == 0:
+            return int(i), int(ts)
+        return i, ts
+
+    def estimate_block(self, ts):
+        # estimate of the first block at or after timestamp ts (or an array of
+        # timestamps) by linear interpolation between slots, exact at slot times
+        block_nums, timestamps = self.arrays()
+        est = np.ceil(np.interp(ts, timestamps, block_nums)).astype(np.int64)
+        return int(est) if np.ndim(est) == 0 else est
 
-        return block_nums, timestamps
+    def estimate_timestamp(self, block):
+        # estimate of the timestamp of block (or an array of blocks) by linear
+        # interpolation between slots, exact at slot blocks
+        block_nums, timestamps = self.arrays()
+        est = np.interp(block, block_nums, timestamps)
+        return float(est) if np.ndim(est) == 0 else est
 
 if __name__ == "__main__":
     b = Blocktimes()
@@ -1,11 +1,23 @@
 from assetregister import AssetRegister
+from metrics import metrics
+from priceengine import AsyncPriceEngine
+from pyramid import PricePyramid
+
+METRICS_FILENAME = 'data/metrics'
 
 ar = AssetRegister()
 ar.add_all_assets()
 ar.export_token_info()
 ar.blocktimes.update()
 ar.blocktimes.save()
+print(f"calculating price histories for {', '.join(ar.token_lookup)}")
+AsyncPriceEngine(ar).run()
 for sym, adr in ar.token_lookup.items():
-    print(f"calculating price history for {sym}")
-    ar.calculate_price_history_in_eth(sym)
     ar.save_price_history(sym)
+    ar.export_price_history_json(sym)
+    PricePyramid(ar, sym).build()
+cache = ar.web3.provider.cache.stats()
+print(f"rpc cache: {cache['hits']} hits, {cache['misses']} misses")
+print(metrics.report_string())
+metrics.save_json(METRICS_FILENAME + '.json')
+metrics.save_prometheus(METRICS_FILENAME + '.prom')
@@ -0,0 +1,84 @@
+import numpy as np
+
+from rpc import BATCH_SIZE
+
+class CrossRates:
+    # price of every token in terms of every other over a list of blocks. Each
+    # token's ETH pools are fetched once, and the pairwise prices are worked out from
+    # them, so N tokens cost as many requests as N price histories in ETH rather
+    # than the N² of calling AssetRegister.get_price for every pair
+    def __init__(self, symbols, blocks, pools):
+        self.symbols = list(symbols)
+        self.blocks = np.asarray(blocks)
+        # float64 array of shape (tokens, blocks, 4) holding the V1 token, V1 ether,
+        # V2 token and V2 ether pool balances
+        self.pools = pools
+
+    @classmethod
+    def from_register(cls, asset_register, blocks, identifiers=None,
+                      batch_size=BATCH_SIZE, from_logs=False):
+        # fetch the pools of the given tokens (all tokens in the register by default)
+        # at each of blocks, which must be ascending if from_logs is set
+        if not identifiers:
+            identifiers = list(asset_register.token_lookup)
+        blocks = [int(n) for n in blocks]
+        step, get_pools = asset_register.get_pools_getter(batch_size, from_logs)
+
+        pools = np.zeros((len(identifiers), len(blocks), 4))
+        for j, identifier in enumerate(identifiers):
+            for i in range(0, len(blocks), step):
+                pools[j, i:i+step] = get_pools(identifier, blocks[i:i+step])
+
+        symbols = [asset_register.get_token_info(identifier)['symbol']
+                   for identifier in identifiers]
+        return cls(symbols, blocks, pools)
+
+    def in_eth(self, symbol=None):
+        # price in ETH of one token, or of every token as an array of shape
+        # (tokens, blocks), with NaN where there is no liquidity
+        pools = self.pools if symbol is None else self.pools[self.symbols.index(symbol)]
+        return combine_pools(*np.moveaxis(pools, -1, 0))
+
+    def price(self, symbol_A, symbol_B):
+        # price of token A in terms of token B at each block
+        pools_A = self.pools[self.symbols.index(symbol_A)]
+        pools_B = self.pools[self.symbols.index(symbol_B)]
+        return cross_prices(pools_A, pools_B)
+
+    def cube(self):
+        # prices of every token (first axis) in terms of every other (second axis) at
+        # each block (third axis). Worked out one token at a time, to keep the
+        # temporary arrays to the size of the result for a single token
+        n = len(self.symbols)
+        result = np.empty((n, n, len(self.blocks)))
+        for j in range(n):
+            result[j] = cross_prices(self.pools[j], self.pools)
+        return result
+
+def cross_prices(pools_A, pools_B):
+    # price of A in terms of B from arrays of pools with the last axis as in
+    # CrossRates.pools, broadcasting over the other axes
+    pool_A1, eth_A1, pool_A2, eth_A2 = np.moveaxis(pools_A, -1, 0)
+    pool_B1, eth_B1, pool_B2, eth_B2 = np.moveaxis(pools_B, -1, 0)
+    pool_A1, pool_B1 = reweight_pools(pool_A1, eth_A1, pool_B1, eth_B1)
+    pool_A2, pool_B2 = reweight_pools(pool_A2, eth_A2, pool_B2, eth_B2)
+    return combine_pools(pool_A1, pool_B1, pool_A2, pool_B2)
+
+def reweight_pools(pool_A, eth_A, pool_B, eth_B):
+    # vectorized assetregister.reweight_pools, with the same order of operations so
+    # that the results are identical
+    with np.errstate(divide='ignore', invalid='ignore'):
+        A_price = eth_A / pool_A
+        B_price = eth_B / pool_B
+        A_deeper = eth_A > eth_B
+        new_A = np.where(A_deeper, eth_B / A_price, pool_A)
+        new_B = np.where(A_deeper, pool_B, eth_A / B_price)
+    empty = (pool_A == 0) | (eth_A == 0) | (pool_B == 0) | (eth_B == 0)
+    return np.where(empty, 0., new_A), np.where(empty, 0., new_B)
+
+def combine_pools(pool_A1, pool_B1, pool_A2, pool_B2):
+    # vectorized assetregister.combine_pools, with NaN in place of None
+    total_A = pool_A1 + pool_A2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        price = (pool_B1 + pool_B2) / total_A
+    return np.where(total_A == 0, np.nan, price)
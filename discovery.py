@@ -0,0 +1,214 @@
+import json
+
+from eth_abi import decode_abi
+from eth_utils import encode_hex, event_abi_to_log_topic
+
+from assetregister import (DATA_DIR, UNISWAP_V1_DEPLOY_BLOCK, UNISWAP_V1_FAC_ABI,
+                           UNISWAP_V1_FAC_ADR, UNISWAP_V2_DEPLOY_BLOCK, UNISWAP_V2_FAC_ABI,
+                           UNISWAP_V2_FAC_ADR, WETH_ADR, get_abi, get_contract)
+from pricestore import write_atomic
+from rpc import BATCH_SIZE, block_param, eth_call, get_logs, post_batch
+
+DISCOVERY_FILENAME = DATA_DIR + 'discovery.json'
+DISCOVERY_CHUNK_SIZE = 20000 # number of blocks of factory logs fetched per request
+MIN_LIQUIDITY = 10 # ether in a token's exchanges for it to be registered
+ZERO_ADR = '0x' + '0' * 40
+
+class TokenDiscovery:
+    # finds the tokens traded on Uniswap from the NewExchange and PairCreated events
+    # of the factories, rather than the hand maintained tokens file, and registers
+    # those with at least min_liquidity ether in their exchanges with an
+    # AssetRegister. The exchange metadata comes from the events (the deploy block is
+    # the block of the event), so adding the tokens takes no further lookups.
+    # Every exchange found is kept in state_filename along with the last block
+    # scanned, so each run only fetches the events after it, and the tokens which
+    # didn't have enough liquidity are checked again
+    def __init__(self, asset_register, min_liquidity=MIN_LIQUIDITY,
+                 chunk_size=DISCOVERY_CHUNK_SIZE, batch_size=BATCH_SIZE,
+                 state_filename=DISCOVERY_FILENAME):
+        self.asset_register = asset_register
+        self.min_liquidity = min_liquidity
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.state_filename = state_filename
+        try:
+            with open(state_filename) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {'last_block': None, 'exchanges': {}, 'tokens': {}}
+        self.last_block = state['last_block']
+        self.exchanges = state['exchanges'] # token address: {'v1', 'v2'} exchanges
+        self.tokens = state['tokens']       # key in token_lookup: token info
+
+        # tokens registered by earlier runs
+        for key, info in self.tokens.items():
+            asset_register.token_lookup.setdefault(key, info)
+
+    def run(self, to_block=None):
+        # scan the factory events up to to_block (the latest block by default) and
+        # register the new tokens with enough liquidity, returning their keys
+        web3 = self.asset_register.web3
+        head = web3.eth.blockNumber if to_block is None else to_block
+        start = 0 if self.last_block is None else self.last_block + 1
+        self.find_exchanges(max(start, UNISWAP_V1_DEPLOY_BLOCK),
+                            max(start, UNISWAP_V2_DEPLOY_BLOCK), head)
+
+        known = {info['address'].lower() for info in
+                 self.asset_register.token_lookup.values()}
+        candidates = [token for token in self.exchanges if token not in known]
+        liquid = [token for token, ether in
+                  zip(candidates, self.get_liquidity(candidates, head))
+                  if ether >= self.min_liquidity]
+        added = self.register(liquid, head)
+
+        self.record_exchanges(head)
+        self.last_block = head
+        write_atomic(self.state_filename, json.dumps(
+            {'last_block': self.last_block, 'exchanges': self.exchanges,
+             'tokens': self.tokens}, separators=(',', ':')))
+        return added
+
+    def find_exchanges(self, v1_from_block, v2_from_block, to_block):
+        # add the exchanges created between the from blocks and to_block (inclusive)
+        # to self.exchanges. V2 pairs are only of interest if one side is WETH
+        web3 = self.asset_register.web3
+        factory = get_contract(web3, UNISWAP_V1_FAC_ADR, UNISWAP_V1_FAC_ABI)
+        event = factory.events.NewExchange()
+        for log in get_logs(web3, UNISWAP_V1_FAC_ADR, [topic(event)], v1_from_block,
+                            to_block, self.chunk_size):
+            args = event.processLog(log).args
+            self.add_exchange(args.token, 'v1', args.exchange, log.blockNumber)
+
+        factory = get_contract(web3, UNISWAP_V2_FAC_ADR, UNISWAP_V2_FAC_ABI)
+        event = factory.events.PairCreated()
+        for log in get_logs(web3, UNISWAP_V2_FAC_ADR, [topic(event)], v2_from_block,
+                            to_block, self.chunk_size):
+            args = event.processLog(log).args
+            if WETH_ADR not in (args.token0, args.token1):
+                continue
+            token = args.token1 if args.token0 == WETH_ADR else args.token0
+            self.add_exchange(token, 'v2', args.pair, log.blockNumber)
+
+    def add_exchange(self, token, version, address, block):
+        exchanges = self.exchanges.setdefault(token.lower(), {'address': token})
+        exchanges[version] = {'address': address, 'deploy_block': block}
+
+    def get_liquidity(self, tokens, block):
+        # ether held by the exchanges of each token at block
+        web3 = self.asset_register.web3
+        weth = get_contract(web3, WETH_ADR, get_abi(WETH_ADR))
+        requests_, owners = [], []
+        for token in tokens:
+            for version in ('v1', 'v2'):
+                exchange = self.exchanges[token].get(version)
+                if exchange is None:
+                    continue
+                if version == 'v1':
+                    requests_.append(('eth_getBalance', [exchange['address'],
+                                                         block_param(block)]))
+                else:
+                    requests_.append(eth_call(weth, 'balanceOf', [exchange['address']],
+                                              block))
+                owners.append(token)
+
+        liquidity = dict.fromkeys(tokens, 0)
+        for token, result in zip(owners, self.call_all(requests_)):
+            if result:
+                liquidity[token] += int(result, 16) * 10 ** -18
+        return [liquidity[token] for token in tokens]
+
+    def register(self, tokens, block):
+        # look up the decimals, symbol and name of tokens and add them to the
+        # AssetRegister, returning their keys in token_lookup
+        ar = self.asset_register
+        requests_ = []
+        for token in tokens:
+            contract = get_contract(ar.web3, self.exchanges[token]['address'],
+                                    get_abi(token))
+            requests_ += [eth_call(contract, fn_name, [], block)
+                          for fn_name in ('decimals', 'symbol', 'name')]
+        results = self.call_all(requests_)
+
+        added = []
+        for i, token in enumerate(tokens):
+            decimals, symbol, name = results[3*i:3*i+3]
+            # tokens without decimals can't be priced
+            if not decimals or decimals == '0x':
+                continue
+            symbol, name = decode_text(symbol), decode_text(name)
+            address = self.exchanges[token]['address']
+            key = symbol
+            if not key or key in ar.token_lookup:
+                key = f"{symbol or 'TOKEN'}-{token[2:10]}"
+            info = {'name': name or key, 'address': address}
+            ar.token_lookup[key] = info
+            self.tokens[key] = info
+            self.exchanges[token]['decimals'] = int(decimals, 16)
+            added.append(key)
+        return added
+
+    def record_exchanges(self, head):
+        # exchange metadata for the registered tokens, so that AssetRegister.add_asset
+        # needn't look anything up. A token without an exchange of one version is
+        # recorded as having none until head, up to which the events were scanned
+        ar = self.asset_register
+        changed = False
+        for token, exchanges in self.exchanges.items():
+            if 'decimals' not in exchanges and token not in ar.exchange_metadata:
+                continue
+            metadata = ar.exchange_metadata.get(token, {})
+            decimals = exchanges.get('decimals', next(
+                (m.get('token_decimals', m.get('token_A_decimals'))
+                 for m in metadata.values()), None))
+            if decimals is None:
+                continue
+            for version in ('v1', 'v2'):
+                exchange = exchanges.get(version)
+                if version in metadata and \
+                   (int(metadata[version]['address'], 16) or exchange is None):
+                    continue
+                if exchange is None:
+                    exchange = {'address': ZERO_ADR, 'deploy_block': head}
+                if version == 'v1':
+                    metadata['v1'] = dict(exchange, token_decimals=decimals)
+                else:
+                    metadata['v2'] = dict(exchange, token_A_decimals=decimals,
+                                          token_B_decimals=18)
+                changed = True
+            ar.exchange_metadata[token] = metadata
+        if changed:
+            ar.save_exchange_metadata()
+
+    def call_all(self, requests_):
+        # results of requests, in batches, with None for those which fail (calls to
+        # functions which a token doesn't have, for instance). A batch containing
+        # an error is sent again a request at a time to find which
+        provider = self.asset_register.web3.provider
+        batch_size = max(self.batch_size, 1)
+        results = []
+        for i in range(0, len(requests_), batch_size):
+            batch = requests_[i:i + batch_size]
+            try:
+                results += post_batch(provider, batch)
+            except ValueError:
+                for request in batch:
+                    try:
+                        results += post_batch(provider, [request])
+                    except ValueError:
+                        results.append(None)
+        return results
+
+def topic(event):
+    return encode_hex(event_abi_to_log_topic(event.abi))
+
+def decode_text(result):
+    # the result of a token's symbol or name call, which is usually a string, but
+    # is bytes32 for some early tokens such as MKR
+    data = bytes.fromhex(result[2:]) if result else b''
+    try:
+        text = decode_abi(['string'], data)[0] if len(data) > 32 else None
+    except Exception:
+        text = None
+    if text is None:
+        text = data[:32].rstrip(b'\0').decode('utf-8', 'replace')
+    return text.replace('\0', '').strip()
@@ -0,0 +1,212 @@
+import json
+import time
+
+from assetregister import BLOCKTIMES_FILENAME, NODE_URL, AssetRegister, combine_pools
+from pricestore import (append_prices, load_prices, meta_filename, save_prices,
+                        truncate_prices)
+from pyramid import PricePyramid
+from rpc import BATCH_SIZE, batch_request, block_param
+
+POLL_INTERVAL = 15 # seconds between polls of the node for new blocks
+REORG_SLOTS = 3 # number of the latest slots checked for (and recalculated after) a reorg
+
+class Follower:
+    # keeps the blocktimes and price histories of an AssetRegister up to date as the
+    # chain grows, polling the node for new blocks. As each slot closes (its block,
+    # the first at or after its time, exists) it is added to the blocktimes, every
+    # tracked token is priced at just that slot, with the pool requests for all of
+    # them in one batch, and the prices are appended to the saved histories.
+    # The hashes of the blocks of the last reorg_slots slots are checked on every
+    # poll, and if one has changed (a reorganisation of the chain) the slots from it
+    # on are dropped from the blocktimes and the histories and calculated again.
+    # Responses at the blocks of those slots are kept out of the RPC cache, and the
+    # timestamps of the blocks after the last slot aren't kept either. The coarse
+    # levels of the PricePyramid of each history which changed are rebuilt
+    def __init__(self, asset_register, identifiers=None, interval=POLL_INTERVAL,
+                 reorg_slots=REORG_SLOTS, batch_size=BATCH_SIZE,
+                 blocktimes_filename=BLOCKTIMES_FILENAME):
+        self.asset_register = asset_register
+        self.identifiers = identifiers # tokens followed, or all with price histories
+        self.interval = interval
+        self.reorg_slots = reorg_slots
+        self.batch_size = batch_size
+        self.blocktimes_filename = blocktimes_filename
+        self.hashes = {} # slot index: hash of its block when the slot was priced
+        self.changed = set() # addresses of the histories changed since the last build
+
+    def tracked(self):
+        ar = self.asset_register
+        if self.identifiers is None:
+            return list(ar.price_histories)
+        return [ar.get_token_info(identifier)['address']
+                for identifier in self.identifiers]
+
+    def run(self, polls=None):
+        # follow the chain, polling every interval seconds (polls times, or forever).
+        # A poll which fails is left to the next one, which picks up where it stopped
+        self.start()
+        count = 0
+        while polls is None or count < polls:
+            try:
+                added = self.poll()
+                if added:
+                    self.asset_register.blocktimes.print_latest()
+            except (OSError, ValueError) as e:
+                print(f"{e!r}, polling again in {self.interval}s")
+            count += 1
+            if polls is None or count < polls:
+                time.sleep(self.interval)
+
+    def start(self):
+        # tokens without histories are calculated in full first. The last
+        # reorg_slots slots (and any prices saved beyond the blocktimes) are then
+        # dropped, since they may have changed while the chain wasn't followed
+        ar = self.asset_register
+        for address in self.tracked():
+            if address not in ar.price_histories:
+                ar.calculate_price_history_in_eth(address, batch_size=self.batch_size)
+        self.rewind(max(len(ar.blocktimes.block_nums) - self.reorg_slots, 0))
+
+    def poll(self):
+        # bring the blocktimes and histories up to the latest block, returning the
+        # number of slots the blocktimes grew by
+        bt = self.asset_register.blocktimes
+        length = len(bt.block_nums)
+        first = self.find_reorg()
+        if first is not None:
+            print(f"chain reorganised from slot {first}, recalculating")
+            self.rewind(first)
+
+        n = len(bt.block_nums)
+        if n:
+            bt.forget_timestamps(bt.block_nums[-1])
+        bt.generate_sequence()
+        self.limit_cache()
+
+        # the hashes are taken before pricing, so a reorg in between is found by the
+        # next poll rather than missed
+        new = range(max(n, len(bt.block_nums) - self.reorg_slots), len(bt.block_nums))
+        self.hashes.update(zip(new, self.block_hashes([bt.block_nums[i] for i in new])))
+        for i in [i for i in self.hashes if i < len(bt.block_nums) - self.reorg_slots]:
+            del self.hashes[i]
+
+        self.price_new_slots()
+        if len(bt.block_nums) != n or first is not None:
+            bt.save(self.blocktimes_filename)
+        for address in self.changed:
+            PricePyramid(self.asset_register, address).build()
+        self.changed.clear()
+        return len(bt.block_nums) - length
+
+    def find_reorg(self):
+        # index of the first of the checked slots whose block has changed, if any
+        bt = self.asset_register.blocktimes
+        slots = sorted(i for i in self.hashes if i < len(bt.block_nums))
+        hashes = self.block_hashes([bt.block_nums[i] for i in slots])
+        return next((i for i, h in zip(slots, hashes) if h != self.hashes[i]), None)
+
+    def block_hashes(self, blocks):
+        if not blocks:
+            return []
+        results = batch_request(self.asset_register.web3,
+                                [('eth_getBlockByNumber', [block_param(block), False])
+                                 for block in blocks], self.batch_size)
+        return [result['hash'] if result else None for result in results]
+
+    def limit_cache(self):
+        # keep the responses at the blocks of the slots which may be recalculated
+        # out of the RPC cache
+        ar = self.asset_register
+        cache = getattr(ar.web3.provider, 'cache', None)
+        block_nums = ar.blocktimes.block_nums
+        if cache is not None and block_nums:
+            cache.max_block = block_nums[max(len(block_nums) - self.reorg_slots, 0)] - 1
+
+    def rewind(self, first):
+        # drop the slots from index first on from the blocktimes and histories
+        ar = self.asset_register
+        ar.blocktimes.truncate(first)
+        self.limit_cache()
+        for i in [i for i in self.hashes if i >= first]:
+            del self.hashes[i]
+        for address in self.tracked():
+            history = ar.price_histories[address]
+            length = max(first - history['start_index'], 0)
+            if len(history['prices']) > length:
+                self.store(address, [], length)
+
+    def price_new_slots(self):
+        # price every tracked token at the slots after the end of its history, with
+        # the pool requests for all of them sent together. A missing exchange (one
+        # which doesn't exist()) makes no requests, and has no pools
+        ar = self.asset_register
+        block_nums = ar.blocktimes.block_nums
+        slots, pool_requests = [], []
+        for address in self.tracked():
+            history = ar.price_histories[address]
+            exchanges = (ar.get_exchange(address, uniswap_version=1),
+                         ar.get_exchange(address, uniswap_version=2))
+            for i in range(history['start_index'] + len(history['prices']),
+                           len(block_nums)):
+                slots.append(address)
+                pool_requests += [(ex, ex.get_pools_requests(block_nums[i]))
+                                  for ex in exchanges]
+        if not slots:
+            return
+        results = batch_request(ar.web3, [r for _, reqs in pool_requests for r in reqs],
+                                self.batch_size)
+
+        pools, k = [], 0
+        for ex, reqs in pool_requests:
+            pools += ex.decode_pools(results[k:k+len(reqs)])
+            k += len(reqs)
+        prices = {}
+        for j, address in enumerate(slots):
+            price = combine_pools(*pools[4*j:4*j+4])
+            prices.setdefault(address, []).append(price if price else 0)
+        for address, new_prices in prices.items():
+            self.store(address, new_prices)
+
+    def store(self, address, prices, length=None):
+        # save a token's history as its first length prices (all of them by default)
+        # followed by prices, appending to the saved history where it already holds
+        # those, and memory-map it again
+        ar = self.asset_register
+        history = ar.price_histories[address]
+        if length is None:
+            length = len(history['prices'])
+        filename = ar.price_filename(address)
+        try:
+            with open(meta_filename(filename)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            meta = None
+        if meta and meta['start_index'] == history['start_index'] and \
+           meta['length'] >= length:
+            if meta['length'] > length:
+                truncate_prices(filename, length)
+            if prices:
+                append_prices(filename, prices)
+        else:
+            save_prices(filename, dict(history, prices=list(history['prices'][:length]) +
+                                       list(prices)))
+        ar.price_histories[address] = load_prices(filename)
+        self.changed.add(address)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='keep the blocktimes and price '
+                                                 'histories up to date with the chain')
+    parser.add_argument('tokens', nargs='*',
+                        help='tokens to follow (all in the tokens file by default)')
+    parser.add_argument('--node-url', default=NODE_URL)
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL)
+    parser.add_argument('--reorg-slots', type=int, default=REORG_SLOTS)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    ar = AssetRegister(args.node_url)
+    for token in args.tokens or ar.token_lookup:
+        ar.add_asset(token)
+    Follower(ar, args.tokens or None, args.interval, args.reorg_slots,
+             args.batch_size).run()
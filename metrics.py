@@ -0,0 +1,147 @@
+import json
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from web3 import HTTPProvider
+
+# upper bounds (in seconds) of the buckets of the request latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PREFIX = 'alabio_'
+
+def escape_label(value):
+    # a label value as written in the Prometheus text format
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    # counts, errors and latency histograms of the JSON-RPC requests sent to the
+    # node, by method, along with the time spent in each stage of the pipeline.
+    # Requests sent in a batch are counted under their own methods, but the latency
+    # is recorded for the batch as a whole, under the method 'batch'
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reporter = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.time()
+            self.requests = {}  # method: {'count', 'errors', 'seconds', 'buckets'}
+            self.stages = {}    # (name, labels): {'count', 'seconds'}
+
+    def record_request(self, method, seconds=None, error=False, count=1):
+        # record count requests for method, which failed if error is set, taking
+        # seconds between them (or None if they were timed as part of a batch)
+        with self.lock:
+            if method not in self.requests:
+                self.requests[method] = {'count': 0, 'errors': 0, 'seconds': 0.,
+                                         'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+            r = self.requests[method]
+            r['count'] += count
+            r['errors'] += count if error else 0
+            if seconds is not None:
+                r['seconds'] += seconds
+                r['buckets'][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    @contextmanager
+    def stage(self, name, **labels):
+        # time the code in a with block as a stage of the pipeline, such as
+        # metrics.stage('pricing', token='DAI')
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            key = (name, tuple(sorted(labels.items())))
+            with self.lock:
+                s = self.stages.setdefault(key, {'count': 0, 'seconds': 0.})
+                s['count'] += 1
+                s['seconds'] += elapsed
+
+    def summary(self):
+        with self.lock:
+            requests = {method: dict(r, buckets=dict(zip(
+                            [str(b) for b in LATENCY_BUCKETS] + ['+Inf'], r['buckets'])))
+                        for method, r in sorted(self.requests.items())}
+            stages = [dict(stage=name, labels=dict(labels), **s)
+                      for (name, labels), s in sorted(self.stages.items())]
+            elapsed = time.time() - self.start_time
+        return {'elapsed': elapsed, 'requests': requests, 'stages': stages}
+
+    def save_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+    def prometheus(self):
+        # the metrics in the Prometheus text exposition format
+        summary = self.summary()
+        lines = [f"# TYPE {PREFIX}rpc_requests_total counter",
+                 f"# TYPE {PREFIX}rpc_errors_total counter",
+                 f"# TYPE {PREFIX}rpc_latency_seconds histogram"]
+        for method, r in summary['requests'].items():
+            label = f'method="{escape_label(method)}"'
+            lines.append(f"{PREFIX}rpc_requests_total{{{label}}} {r['count']}")
+            lines.append(f"{PREFIX}rpc_errors_total{{{label}}} {r['errors']}")
+            total = 0
+            for le, n in r['buckets'].items():
+                total += n
+                lines.append(f'{PREFIX}rpc_latency_seconds_bucket{{{label},le="{le}"}} '
+                             f'{total}')
+            lines.append(f"{PREFIX}rpc_latency_seconds_sum{{{label}}} {r['seconds']}")
+            lines.append(f"{PREFIX}rpc_latency_seconds_count{{{label}}} {total}")
+
+        lines += [f"# TYPE {PREFIX}stage_seconds_total counter",
+                  f"# TYPE {PREFIX}stage_runs_total counter"]
+        for s in summary['stages']:
+            labels = ','.join(f'{k}="{escape_label(v)}"' for k, v in
+                              [('stage', s['stage'])] + list(s['labels'].items()))
+            lines.append(f"{PREFIX}stage_seconds_total{{{labels}}} {s['seconds']}")
+            lines.append(f"{PREFIX}stage_runs_total{{{labels}}} {s['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def save_prometheus(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.prometheus())
+
+    def report_string(self):
+        # one line summary of the requests made so far
+        summary = self.summary()
+        requests = [r for method, r in summary['requests'].items() if method != 'batch']
+        count = sum(r['count'] for r in requests)
+        errors = sum(r['errors'] for r in requests)
+        timed = [(method, r['seconds'] / max(sum(r['buckets'].values()), 1))
+                 for method, r in summary['requests'].items() if r['seconds']]
+        latencies = ', '.join(f"{method} {1000 * mean:.1f}ms" for method, mean in timed)
+        return (f"{count} requests ({errors} errors) in {summary['elapsed']:.0f}s, "
+                f"mean latency: {latencies or 'n/a'}")
+
+    def start_reporting(self, interval=60):
+        # print report_string every interval seconds, until stop_reporting is called
+        self.stop_reporting()
+        stop = threading.Event()
+        def report():
+            while not stop.wait(interval):
+                print(self.report_string())
+        self.reporter = stop
+        threading.Thread(target=report, daemon=True).start()
+
+    def stop_reporting(self):
+        if self.reporter:
+            self.reporter.set()
+            self.reporter = None
+
+# metrics of the whole process, used by everything which is instrumented
+metrics = Metrics()
+
+class MeteredHTTPProvider(HTTPProvider):
+    # HTTPProvider which records every request it sends in metrics
+    def make_request(self, method, params):
+        start = time.time()
+        try:
+            response = super().make_request(method, params)
+        except Exception:
+            metrics.record_request(method, time.time() - start, error=True)
+            raise
+        metrics.record_request(method, time.time() - start, error='error' in response)
+        return response
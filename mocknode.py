@@ -0,0 +1,308 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from web3 import Web3
+
+# local stand-in for an Ethereum archive node, serving a deterministic synthetic
+# chain with Uniswap V1 and V2 exchanges for a handful of tokens, so that the
+# price pipeline can be run (and timed) without a real node
+
+GENESIS_TS = 1438269973
+HEAD = 10100000 # latest block of the synthetic chain
+TRADE_PERIOD = 37 # blocks between trades on each exchange
+V1_FAC_ADR = '0xc0a47dfe034b400b47bdad5fecda2621de6c4d95'
+V2_FAC_ADR = '0x5c69bee701ef814a2b6a3edd4b1652cb9cc5aa6f'
+WETH_ADR = '0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2'
+V1_DEPLOY_BLOCK = 6627917
+V2_DEPLOY_BLOCK = 10000835
+ZERO_ADR = '0x' + '0' * 40
+
+# symbol: (address, decimals)
+TOKENS = {
+    'DAI': ('0x6B175474E89094C44Da98b954EedeAC495271d0F', 18),
+    'MKR': ('0x9f8F72aA9304c8B593d555F12eF6589cC3A579A2', 18),
+    'USDC': ('0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48', 6),
+}
+
+# tokens whose name and symbol are bytes32 rather than strings, as for the real MKR
+BYTES32_TOKENS = ('MKR',)
+
+SELECTORS = {'70a08231': 'balanceOf', '313ce567': 'decimals', '06f2bf62': 'getExchange',
+             'e6a43905': 'getPair', '95d89b41': 'symbol', '06fdde03': 'name',
+             '0902f1ac': 'getReserves'}
+TOPICS = {name: Web3.keccak(text=signature).hex() for name, signature in (
+    ('TokenPurchase', 'TokenPurchase(address,uint256,uint256)'),
+    ('EthPurchase', 'EthPurchase(address,uint256,uint256)'),
+    ('AddLiquidity', 'AddLiquidity(address,uint256,uint256)'),
+    ('RemoveLiquidity', 'RemoveLiquidity(address,uint256,uint256)'),
+    ('Sync', 'Sync(uint112,uint112)'),
+    ('NewExchange', 'NewExchange(address,address)'),
+    ('PairCreated', 'PairCreated(address,address,address,uint256)'))}
+
+def word(n):
+    return '%064x' % n
+
+def address_word(address):
+    return '0' * 24 + address[2:].lower()
+
+def encode_text(text, bytes32=False):
+    data = text.encode()
+    if bytes32:
+        return data.hex().ljust(64, '0')
+    return word(32) + word(len(data)) + data.hex().ljust(64 * -(-len(data) // 32), '0')
+
+class MockNode:
+    # answers JSON-RPC requests for the synthetic chain. Every token has a V1 and
+    # a V2 exchange, deployed a little after the respective factories, whose pools
+    # change every TRADE_PERIOD blocks
+    def __init__(self, head=HEAD, latency=0, tokens=TOKENS):
+        self.head = head
+        self.fork = 0 # number of reorgs made, and the first block replaced by the last
+        self.fork_block = None
+        self.latency = latency # seconds added to every HTTP request
+        self.calls = 0 # number of JSON-RPC requests answered (counting each in a batch)
+        self.lock = threading.Lock()
+        self.exchanges = {}
+        for i, (symbol, (address, decimals)) in enumerate(sorted(tokens.items())):
+            self.exchanges[address.lower()] = {
+                'symbol': symbol, 'decimals': decimals, 'seed': i + 1,
+                'v1': '0x' + ('a1%02d' % i) * 10, 'v2': '0x' + ('b2%02d' % i) * 10,
+                'v1_deploy': V1_DEPLOY_BLOCK + 1000 * (i + 1),
+                'v2_deploy': V2_DEPLOY_BLOCK + 500 * (i + 1) + 3}
+
+    def timestamp(self, block):
+        return GENESIS_TS + 13 * block + (0 if block == 0 else (block * 7919) % 5)
+
+    def trades(self, exchange, version, block):
+        # number of trades made on an exchange by block, less one (-1 before deployment)
+        deploy = exchange['v%d_deploy' % version]
+        return -1 if block < deploy else (block - deploy) // TRADE_PERIOD
+
+    def pools(self, exchange, version, trade):
+        # raw (token, ether) balances after the given trade
+        if trade < 0:
+            return 0, 0
+        seed = exchange['seed'] + version
+        ether = 10 ** 18 * (1000 + (trade * 37 * seed) % 101) + trade * 12345
+        tokens = 10 ** exchange['decimals'] * (200000 + (trade * 53 * seed) % 997)
+        return tokens, ether
+
+    def pools_at(self, exchange, version, block):
+        tokens, ether = self.pools(exchange, version, self.trades(exchange, version, block))
+        if self.forked(block) and ether:
+            ether += self.fork * 10 ** 17
+        return tokens, ether
+
+    def reorg(self, depth):
+        # replace the last depth blocks with others, with different hashes and pools
+        self.fork += 1
+        self.fork_block = self.head - depth + 1
+
+    def forked(self, block):
+        return self.fork_block is not None and block >= self.fork_block
+
+    def block_num(self, tag):
+        if tag in ('latest', 'pending'):
+            return self.head
+        if tag == 'earliest':
+            return 0
+        return int(tag, 16)
+
+    def handle(self, request):
+        with self.lock:
+            self.calls += 1
+        method, params = request['method'], request.get('params', [])
+        try:
+            response = {'result': getattr(self, method)(*params)}
+        except Exception as e:
+            response = {'error': {'code': -32000, 'message': repr(e)}}
+        return dict(response, jsonrpc='2.0', id=request.get('id'))
+
+    def eth_chainId(self):
+        return '0x1'
+
+    def net_version(self):
+        return '1'
+
+    def eth_blockNumber(self):
+        return hex(self.head)
+
+    def eth_getBlockByNumber(self, tag, full_transactions=False):
+        block = self.block_num(tag)
+        if block > self.head:
+            return None
+        return {'number': hex(block), 'timestamp': hex(self.timestamp(block)),
+                'hash': '0x' + word(self.block_hash(block)),
+                'parentHash': '0x' + word(self.block_hash(block - 1)),
+                'transactions': []}
+
+    def block_hash(self, block):
+        return block + 1 + (self.fork << 128 if self.forked(block) else 0)
+
+    def eth_getCode(self, address, tag):
+        block, address = self.block_num(tag), address.lower()
+        for exchange in self.exchanges.values():
+            for version in (1, 2):
+                if address == exchange['v%d' % version] and \
+                   block >= exchange['v%d_deploy' % version]:
+                    return '0x6060'
+        return '0x'
+
+    def eth_getBalance(self, address, tag):
+        for exchange in self.exchanges.values():
+            if address.lower() == exchange['v1']:
+                return hex(self.pools_at(exchange, 1, self.block_num(tag))[1])
+        return '0x0'
+
+    def eth_call(self, transaction, tag):
+        block = self.block_num(tag)
+        to, data = transaction['to'].lower(), transaction['data'][2:]
+        function, args = SELECTORS[data[:8]], data[8:]
+        if to == V1_FAC_ADR and function == 'getExchange':
+            exchange = self.exchanges.get('0x' + args[24:64])
+            return '0x' + address_word(exchange['v1'] if exchange else ZERO_ADR)
+        if to == V2_FAC_ADR and function == 'getPair':
+            tokens = {'0x' + args[24:64], '0x' + args[88:128]} - {WETH_ADR}
+            exchange = self.exchanges.get(tokens.pop()) if len(tokens) == 1 else None
+            return '0x' + address_word(exchange['v2'] if exchange else ZERO_ADR)
+        if function == 'getReserves':
+            for token, exchange in self.exchanges.items():
+                if to == exchange['v2']:
+                    tokens, ether = self.pools_at(exchange, 2, block)
+                    reserves = (tokens, ether) if int(token, 16) < int(WETH_ADR, 16) \
+                               else (ether, tokens)
+                    return '0x' + word(reserves[0]) + word(reserves[1]) + \
+                           word(self.timestamp(block) % 2 ** 32)
+        if function == 'decimals':
+            return '0x' + word(18 if to == WETH_ADR else self.exchanges[to]['decimals'])
+        if function in ('symbol', 'name'):
+            symbol = self.exchanges[to]['symbol']
+            text = symbol if function == 'symbol' else symbol + ' Token'
+            return '0x' + encode_text(text, symbol in BYTES32_TOKENS)
+        if function == 'balanceOf':
+            owner = '0x' + args[24:64]
+            for token, exchange in self.exchanges.items():
+                if owner == exchange['v1'] and to == token:
+                    return '0x' + word(self.pools_at(exchange, 1, block)[0])
+                if owner == exchange['v2'] and to in (token, WETH_ADR):
+                    pools = self.pools_at(exchange, 2, block)
+                    return '0x' + word(pools[0] if to == token else pools[1])
+            return '0x' + word(0)
+        raise ValueError('unsupported call')
+
+    def eth_getLogs(self, log_filter):
+        first = self.block_num(log_filter.get('fromBlock', 'latest'))
+        last = self.block_num(log_filter.get('toBlock', 'latest'))
+        addresses = log_filter.get('address') or []
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        addresses = [a.lower() for a in addresses]
+        topics = (log_filter.get('topics') or [None])[0]
+        if isinstance(topics, str):
+            topics = [topics]
+
+        logs = []
+        for token, exchange in self.exchanges.items():
+            for version in (1, 2):
+                factory = V1_FAC_ADR if version == 1 else V2_FAC_ADR
+                deploy = exchange['v%d_deploy' % version]
+                if (not addresses or factory in addresses) and first <= deploy <= last:
+                    log = self.creation_log(token, exchange, version)
+                    if topics is None or log['topics'][0] in topics:
+                        logs.append(log)
+
+                address = exchange['v%d' % version]
+                if addresses and address not in addresses:
+                    continue
+                deploy = exchange['v%d_deploy' % version]
+                trade = max(0, -(-(first - deploy) // TRADE_PERIOD))
+                while deploy + trade * TRADE_PERIOD <= last:
+                    for log in self.trade_logs(token, exchange, version, trade):
+                        if topics is None or log['topics'][0] in topics:
+                            logs.append(log)
+                    trade += 1
+        return sorted(logs, key=lambda l: (int(l['blockNumber'], 16),
+                                           int(l['logIndex'], 16)))
+
+    def creation_log(self, token, exchange, version):
+        # the event emitted by the factory when an exchange is created
+        block = exchange['v%d_deploy' % version]
+        log = {'blockNumber': hex(block), 'blockHash': '0x' + word(block + 1),
+               'transactionHash': '0x' + word(block * 7 + 2 + version),
+               'transactionIndex': '0x0', 'removed': False, 'logIndex': '0x0'}
+        if version == 1:
+            return dict(log, address=V1_FAC_ADR, data='0x',
+                        topics=[TOPICS['NewExchange'], '0x' + address_word(token),
+                                '0x' + address_word(exchange['v1'])])
+        token0, token1 = sorted((token, WETH_ADR), key=lambda a: int(a, 16))
+        return dict(log, address=V2_FAC_ADR,
+                    topics=[TOPICS['PairCreated'], '0x' + address_word(token0),
+                            '0x' + address_word(token1)],
+                    data='0x' + address_word(exchange['v2']) + word(exchange['seed']))
+
+    def trade_logs(self, token, exchange, version, trade):
+        # the events emitted by an exchange for a trade
+        block = exchange['v%d_deploy' % version] + trade * TRADE_PERIOD
+        log = {'blockNumber': hex(block), 'blockHash': '0x' + word(block + 1),
+               'transactionHash': '0x' + word(block * 7 + version),
+               'transactionIndex': '0x0', 'removed': False,
+               'address': exchange['v%d' % version]}
+        if version == 2:
+            tokens, ether = self.pools(exchange, 2, trade)
+            reserves = (tokens, ether) if int(token, 16) < int(WETH_ADR, 16) \
+                       else (ether, tokens)
+            return [dict(log, logIndex='0x1', topics=[TOPICS['Sync']],
+                         data='0x' + word(reserves[0]) + word(reserves[1]))]
+
+        tokens_before, ether_before = self.pools(exchange, 1, trade - 1)
+        tokens_after, ether_after = self.pools(exchange, 1, trade)
+        d_tokens, d_ether = tokens_after - tokens_before, ether_after - ether_before
+        if d_ether >= 0 and d_tokens >= 0:
+            name, args = 'AddLiquidity', (d_ether, d_tokens)
+        elif d_ether <= 0 and d_tokens <= 0:
+            name, args = 'RemoveLiquidity', (-d_ether, -d_tokens)
+        elif d_ether > 0:
+            name, args = 'TokenPurchase', (d_ether, -d_tokens)
+        else:
+            name, args = 'EthPurchase', (d_tokens, -d_ether)
+        return [dict(log, logIndex='0x0', data='0x',
+                     topics=[TOPICS[name], '0x' + address_word('0x' + '11' * 20),
+                             '0x' + word(args[0]), '0x' + word(args[1])])]
+
+def serve(node, port=8545):
+    # serve node over HTTP on localhost in a background thread, returning the server
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if node.latency:
+                time.sleep(node.latency)
+            if isinstance(request, list):
+                response = [node.handle(r) for r in request]
+            else:
+                response = node.handle(request)
+            body = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='serve a synthetic archive node')
+    parser.add_argument('--port', type=int, default=8545)
+    parser.add_argument('--latency', type=float, default=0)
+    args = parser.parse_args()
+    serve(MockNode(latency=args.latency), args.port)
+    print(f"mock node listening on http://127.0.0.1:{args.port}")
+    while True:
+        time.sleep(60)
@@ -0,0 +1,129 @@
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+from pricestore import CHECKPOINT_INTERVAL, CHECKPOINT_SLOTS, Checkpointer
+from rpc import BATCH_SIZE
+from utils import progress_string
+
+MAX_IN_FLIGHT = 16 # maximum number of requests (or batches) awaiting the node
+
+class AsyncPriceEngine:
+    # calculates the price histories of several tokens in an AssetRegister
+    # concurrently, keeping up to max_in_flight requests outstanding at the node
+    def __init__(self, asset_register, max_in_flight=MAX_IN_FLIGHT,
+                 batch_size=BATCH_SIZE, from_logs=False, checkpoint_slots=CHECKPOINT_SLOTS,
+                 checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.asset_register = asset_register
+        self.max_in_flight = max_in_flight
+        self.checkpoint_slots = checkpoint_slots
+        self.checkpoint_interval = checkpoint_interval
+        self.step, self.get_prices = asset_register.get_price_getter(batch_size, from_logs)
+        self.done = 0
+        self.total = 0
+
+    def run(self, identifiers=None, clear_existing=False):
+        # blocking entry point: calculate the histories of the given tokens (all
+        # tokens in the register by default) and store them in price_histories
+        if not identifiers:
+            identifiers = list(self.asset_register.token_lookup)
+        asyncio.run(self.calculate_price_histories_in_eth(identifiers, clear_existing))
+
+    async def calculate_price_histories_in_eth(self, identifiers, clear_existing=False):
+        ar = self.asset_register
+        # make sure the exchanges exist before any worker thread needs them
+        for identifier in identifiers:
+            ar.get_exchange(identifier)
+
+        loop = asyncio.get_running_loop()
+        self.done, self.total = 0, 0
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        in_executor = lambda func, *args: loop.run_in_executor(executor, func, *args)
+        progress = asyncio.create_task(self.report_progress())
+        tasks = [asyncio.create_task(self.calculate_price_history_in_eth(
+                     identifier, in_executor, clear_existing)) for identifier in identifiers]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # stop the other tokens (which checkpoint what they have done) and drop
+            # the steps still queued, rather than waiting for them all to fail
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        else:
+            executor.shutdown()
+        finally:
+            progress.cancel()
+            await asyncio.gather(progress, return_exceptions=True)
+
+    async def calculate_price_history_in_eth(self, identifier, in_executor,
+                                             clear_existing=False):
+        # concurrent equivalent of AssetRegister.calculate_price_history_in_eth
+        ar = self.asset_register
+        token_info = ar.get_token_info(identifier)
+        symbol, address = token_info['symbol'], token_info['address']
+        block_nums = ar.blocktimes.block_nums
+
+        if address in ar.price_histories and not clear_existing:
+            start_ind = ar.price_histories[address]['start_index']
+            prices = list(ar.price_histories[address]['prices'])
+            continue_from = start_ind + len(prices)
+        else:
+            ar.price_histories.pop(address, None)
+            with metrics.stage('start_search', token=symbol):
+                start_ind = await in_executor(ar.find_start_index, identifier, self.step,
+                                              self.get_prices)
+            continue_from = start_ind
+            prices = []
+
+        history = {'symbol':symbol, 'address':address, 'start_index':start_ind,
+                   'prices':prices}
+        ar.price_histories[address] = history
+        checkpointer = Checkpointer(ar.price_filename(address), self.checkpoint_slots,
+                                    self.checkpoint_interval)
+
+        self.total += len(block_nums) - continue_from
+
+        # up to max_in_flight steps of each token are submitted at a time. They
+        # complete in any order, but each is only added to the history (and
+        # checkpointed) once all of the steps before it are done
+        steps = deque()
+        try:
+            with metrics.stage('pricing', token=symbol):
+                for i in range(continue_from, len(block_nums), self.step):
+                    steps.append(asyncio.ensure_future(self.get_step(
+                        identifier, block_nums[i:i+self.step], in_executor)))
+                    if len(steps) >= self.max_in_flight:
+                        prices += [price if price else 0 for price in await steps.popleft()]
+                        checkpointer.update(history)
+                while steps:
+                    prices += [price if price else 0 for price in await steps.popleft()]
+                    checkpointer.update(history)
+        finally:
+            # also reached when a step fails or the task is cancelled, keeping what was done
+            for step in steps:
+                step.cancel()
+            checkpointer.update(history, force=True)
+
+    async def get_step(self, identifier, blocks, in_executor):
+        prices = await in_executor(self.get_prices, identifier, blocks)
+        self.done += len(blocks)
+        return prices
+
+    async def report_progress(self, interval=0.2):
+        # single progress line covering every token being calculated
+        start_time = time.time()
+        prog = ''
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if self.total:
+                    prog = progress_string(self.done, self.total, start_time)
+                    print(prog, end='\r')
+        except asyncio.CancelledError:
+            print(' ' * len(prog), end='\r')
+            raise
@@ -0,0 +1,76 @@
+from datetime import datetime
+
+import numpy as np
+
+class PriceMatrix:
+    # prices of several tokens aligned on the Blocktimes grid, with one row per slot
+    # and one column per token, padded with NaN where a token has no history.
+    # Slicing and resampling return views onto the same underlying array
+    def __init__(self, times, symbols, values, start_index, delta):
+        self.times = times           # datetime64[s] (UTC) time of each row
+        self.symbols = list(symbols)
+        self.values = values         # float64 array of shape (rows, symbols)
+        self.start_index = start_index # Blocktimes slot index of the first row
+        self.delta = delta           # seconds between rows
+
+    @classmethod
+    def from_histories(cls, blocktimes, histories, start=None, end=None):
+        # build from a list of price history dicts (symbol, start_index, prices),
+        # with rows for slots start to end (by default, every slot of the histories)
+        start_ind = min(h['start_index'] for h in histories) if start is None else start
+        end_ind = max(h['start_index'] + len(h['prices']) for h in histories) \
+                  if end is None else end
+
+        values = np.full((end_ind - start_ind, len(histories)), np.nan)
+        for j, h in enumerate(histories):
+            first = max(h['start_index'], start_ind)
+            last = min(h['start_index'] + len(h['prices']), end_ind)
+            if first < last:
+                values[first - start_ind:last - start_ind, j] = \
+                    h['prices'][first - h['start_index']:last - h['start_index']]
+
+        times = blocktimes.timestamps(start_ind, end_ind).astype('datetime64[s]')
+        return cls(times, [h['symbol'] for h in histories], values, start_ind,
+                   blocktimes.delta)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, symbol):
+        return self.values[:, self.symbols.index(symbol)]
+
+    def slice(self, start=None, end=None):
+        # rows with times in [start, end), which may be datetimes, datetime64 or
+        # unix timestamps
+        i = 0 if start is None else np.searchsorted(self.times, to_datetime64(start))
+        j = len(self) if end is None else np.searchsorted(self.times, to_datetime64(end))
+        return PriceMatrix(self.times[i:j], self.symbols, self.values[i:j],
+                           self.start_index + i, self.delta)
+
+    def resample(self, factor):
+        # every factor-th row, keeping to slots whose Blocktimes index is a multiple
+        # of factor, so that resampled matrices for different ranges line up
+        first = -self.start_index % factor
+        return PriceMatrix(self.times[first::factor], self.symbols,
+                           self.values[first::factor], self.start_index + first,
+                           self.delta * factor)
+
+    def to_pandas(self):
+        import pandas as pd
+        return pd.DataFrame(self.values, index=pd.DatetimeIndex(self.times, name='time'),
+                            columns=self.symbols)
+
+    def as_dict(self):
+        # the original get_price_time_series format: lists padded with None, with
+        # times as local datetimes, like Blocktimes.datetimes
+        result = {'time': [datetime.fromtimestamp(t) for t in
+                           self.times.astype(np.int64).tolist()]}
+        for j, symbol in enumerate(self.symbols):
+            column = self.values[:, j]
+            result[symbol] = [None if np.isnan(p) else p for p in column.tolist()]
+        return result
+
+def to_datetime64(t):
+    if isinstance(t, (int, float, np.integer, np.floating)):
+        return np.datetime64(int(t), 's')
+    return np.datetime64(t, 's')
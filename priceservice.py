@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from assetregister import BLOCKTIMES_FILENAME, DATA_DIR, PRICES_EXTENSION
+from blocktimes import Blocktimes
+from pricematrix import PriceMatrix, to_datetime64
+from pricestore import load_prices, meta_filename
+
+# local HTTP service answering price queries from the saved histories and blocktimes
+# alone, without an AssetRegister or a node. Every response is JSON:
+#     /tokens                                 the tokens with histories, and their ranges
+#     /prices?tokens=DAI,MKR&start=&end=      prices of tokens on the Blocktimes slots
+#             &resolution=&max_points=&quote= between start and end, as in
+#                                             get_price_time_series
+#     /price?token=DAI&timestamp=|block=      price at the latest slot at or before a
+#            &quote=                          time or block
+# Prices are in ether, or in terms of the quote token if one is given (cross rates of
+# the ether prices). Times may be unix timestamps or ISO 8601 strings, and
+# resolution is in seconds
+
+PORT = 8600
+CACHE_SIZE = 256 # number of responses kept
+
+class PriceService:
+    # the saved data in data_dir, memory mapped, along with the most recent
+    # responses. Whenever the metadata of a history or of the blocktimes is replaced
+    # (as saving them does, even when only appending) they are read again
+    def __init__(self, data_dir=DATA_DIR, blocktimes_filename=BLOCKTIMES_FILENAME,
+                 cache_size=CACHE_SIZE):
+        self.data_dir = data_dir
+        self.blocktimes_filename = blocktimes_filename
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.version = None
+        self.cache = OrderedDict()
+
+    def refresh(self):
+        # only the files read here are looked at, since data_dir also holds files
+        # which change all the time while the pipeline is running (the caches, say)
+        filename, blocktimes_meta = self.blocktimes_filename, \
+                                    meta_filename(self.blocktimes_filename)
+        if not os.path.exists(blocktimes_meta):
+            filename = blocktimes_meta = os.path.splitext(filename)[0] + '.json'
+        metas = sorted(entry.name for entry in os.scandir(self.data_dir)
+                       if entry.name.endswith(meta_filename(PRICES_EXTENSION)))
+        version = [os.stat(blocktimes_meta).st_mtime_ns]
+        version += [(name, os.stat(os.path.join(self.data_dir, name)).st_mtime_ns)
+                    for name in metas]
+        if version == self.version:
+            return
+        self.blocktimes = Blocktimes(filename=filename)
+        self.histories = {}
+        self.tokens = {} # symbol or lowercase address: history filename
+        for name in metas:
+            with open(os.path.join(self.data_dir, name)) as f:
+                meta = json.load(f)
+            filename = os.path.join(self.data_dir, name[:-len('.json')])
+            self.tokens[meta['symbol']] = filename
+            self.tokens[meta['address'].lower()] = filename
+        self.cache.clear()
+        self.version = version
+
+    def history(self, token):
+        filename = self.tokens.get(token) or self.tokens.get(token.lower())
+        if filename is None:
+            raise KeyError(f"no price history for {token}")
+        if filename not in self.histories:
+            self.histories[filename] = load_prices(filename)
+        return self.histories[filename]
+
+    def query(self, path, params):
+        # JSON response body for a request, from the cache if it was made recently
+        key = (path, tuple(sorted(params.items())))
+        with self.lock:
+            self.refresh()
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            handler = {'/tokens': self.list_tokens, '/prices': self.prices,
+                       '/price': self.price}.get(path)
+            if handler is None:
+                raise KeyError(f"unknown query {path}")
+            body = json.dumps(handler(**params), separators=(',', ':')).encode()
+            self.cache[key] = body
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return body
+
+    def list_tokens(self):
+        timestamps = self.blocktimes.timestamps()
+        result = []
+        for filename in sorted(set(self.tokens.values())):
+            history = self.histories.get(filename) or load_prices(filename)
+            self.histories[filename] = history
+            symbol = history['symbol']
+            # a history may be saved before the blocktimes which were extended with it
+            start = history['start_index']
+            length = max(0, min(len(history['prices']), len(timestamps) - start))
+            result.append({'symbol': symbol, 'address': history['address'],
+                           'start': iso(timestamps[start]) if length else None,
+                           'end': iso(timestamps[start + length - 1]) if length else None,
+                           'slots': length})
+        return result
+
+    def prices(self, tokens, start=None, end=None, resolution=None, max_points=None,
+               quote=None):
+        symbols = tokens.split(',')
+        histories = [self.history(symbol) for symbol in symbols]
+        # the quote token's prices are sliced and resampled along with the others
+        if quote is not None:
+            histories.append(self.history(quote))
+        timestamps = self.blocktimes.timestamps()
+        first = min(h['start_index'] for h in histories)
+        last = max(h['start_index'] + len(h['prices']) for h in histories)
+        if start is not None:
+            first = max(first, int(np.searchsorted(timestamps, parse_time(start))))
+        if end is not None:
+            last = min(last, int(np.searchsorted(timestamps, parse_time(end))))
+        last = max(first, min(last, len(timestamps)))
+
+        # only the slots asked for are read from the histories
+        matrix = PriceMatrix.from_histories(self.blocktimes, histories, first, last)
+        factor = 1
+        if resolution is not None:
+            factor = max(1, int(resolution) // self.blocktimes.delta)
+        elif max_points is not None:
+            factor = max(1, -(-len(matrix) // int(max_points)))
+        if factor > 1:
+            matrix = matrix.resample(factor)
+
+        values = matrix.values
+        if quote is not None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = values[:, :-1] / values[:, -1:]
+        block_nums = self.blocktimes.arrays()[0]
+        slots = matrix.start_index + factor * np.arange(len(matrix))
+        result = {'time': [iso(t) for t in matrix.times.astype(np.int64).tolist()],
+                  'block': block_nums[slots].tolist()}
+        for j, symbol in enumerate(symbols):
+            result[symbol] = to_json(values[:, j])
+        return result
+
+    def price(self, token, timestamp=None, block=None, quote=None):
+        block_nums, timestamps = self.blocktimes.arrays()
+        if block is not None:
+            i = int(np.searchsorted(block_nums, int(block), side='right')) - 1
+        elif timestamp is not None:
+            i = int(np.searchsorted(timestamps, parse_time(timestamp), side='right')) - 1
+        else:
+            i = len(block_nums) - 1
+        result = {'token': token, 'slot': i, 'time': None, 'block': None, 'price': None}
+        if i < 0:
+            return result
+        result.update(time=iso(timestamps[i]), block=int(block_nums[i]))
+
+        price = slot_price(self.history(token), i)
+        if quote is not None and price is not None:
+            quote_price = slot_price(self.history(quote), i)
+            price = price / quote_price if quote_price else None
+        result['price'] = price
+        return result
+
+def slot_price(history, i):
+    k = i - history['start_index']
+    if 0 <= k < len(history['prices']):
+        return float(history['prices'][k])
+    return None
+
+def to_json(values):
+    return [None if not np.isfinite(v) else v for v in values.tolist()]
+
+def iso(ts):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(int(ts)))
+
+def parse_time(t):
+    # unix timestamp of a query parameter, given as a timestamp or an ISO 8601 string
+    try:
+        return float(t)
+    except ValueError:
+        return int(to_datetime64(t.rstrip('Z')).astype(np.int64))
+
+def serve(service, port=PORT):
+    # serve queries over HTTP on localhost in a background thread, returning the server
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                body, status = service.query(url.path, params), 200
+            except (KeyError, TypeError, ValueError, IndexError) as e:
+                body, status = json.dumps({'error': str(e)}).encode(), 400
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='serve price queries from the saved '
+                                                 'histories')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--blocktimes', default=BLOCKTIMES_FILENAME)
+    args = parser.parse_args()
+    serve(PriceService(args.data_dir, args.blocktimes), args.port)
+    print(f"price service listening on http://127.0.0.1:{args.port}")
+    while True:
+        time.sleep(60)
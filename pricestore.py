@@ -0,0 +1,139 @@
+import os
+import json
+import time
+
+import fjson
+import numpy as np
+
+DTYPE = 'float64'
+FLOAT_FORMAT = '.5e'
+CHECKPOINT_SLOTS = 10000 # maximum number of new prices held only in memory
+CHECKPOINT_INTERVAL = 300 # maximum number of seconds between checkpoints
+
+# a price history is kept as a raw little-endian array of prices in one file, which
+# can be memory-mapped, with a small JSON metadata file alongside it:
+#     <address>.prices       prices for consecutive Blocktimes slots
+#     <address>.prices.json  {symbol, address, start_index, dtype, length}
+
+def meta_filename(filename):
+    return filename + '.json'
+
+def write_atomic(filename, data, mode='w'):
+    # write to a temporary file and then move it into place, so that readers only
+    # ever see the old or the new contents
+    tmp = filename + '.tmp'
+    with open(tmp, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+def save_prices(filename, history, dtype=DTYPE):
+    # write a price history dict (symbol, address, start_index, prices)
+    prices = np.asarray(history['prices'], dtype=np.dtype(dtype).newbyteorder('<'))
+    write_atomic(filename, prices.tobytes(), 'wb')
+    meta = {'symbol': history['symbol'], 'address': history['address'],
+            'start_index': history['start_index'], 'dtype': prices.dtype.str,
+            'length': len(prices)}
+    write_atomic(meta_filename(filename), json.dumps(meta))
+
+def append_prices(filename, prices):
+    # add prices to the end of a saved history. The metadata is only updated once
+    # the prices are on disk, and anything beyond its length (left by an append
+    # which was interrupted) is discarded first
+    with open(meta_filename(filename)) as f:
+        meta = json.load(f)
+    dtype = np.dtype(meta['dtype'])
+    with open(filename, 'r+b') as f:
+        f.truncate(meta['length'] * dtype.itemsize)
+        f.seek(0, os.SEEK_END)
+        f.write(np.asarray(prices, dtype=dtype).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    meta['length'] += len(prices)
+    write_atomic(meta_filename(filename), json.dumps(meta))
+
+def truncate_prices(filename, length):
+    # shorten a saved history to its first length prices. Only the metadata is
+    # rewritten, and the prices beyond it are discarded by the next append
+    with open(meta_filename(filename)) as f:
+        meta = json.load(f)
+    meta['length'] = min(meta['length'], length)
+    write_atomic(meta_filename(filename), json.dumps(meta))
+
+def load_prices(filename, mmap=True):
+    # read a price history dict, with the prices memory-mapped unless mmap is False
+    with open(meta_filename(filename)) as f:
+        meta = json.load(f)
+    dtype, length = np.dtype(meta.pop('dtype')), meta.pop('length')
+    if length == 0:
+        meta['prices'] = np.zeros(0, dtype=dtype)
+    elif mmap:
+        meta['prices'] = np.memmap(filename, dtype=dtype, mode='r', shape=(length,))
+    else:
+        meta['prices'] = np.fromfile(filename, dtype=dtype, count=length)
+    return meta
+
+def saved_length(filename, start_index):
+    # number of prices in the saved history if it starts at start_index, else None
+    try:
+        with open(meta_filename(filename)) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    return meta['length'] if meta['start_index'] == start_index else None
+
+def export_json(filename, history, float_format=FLOAT_FORMAT):
+    # write a price history in the original text format
+    history = dict(history, prices=[float(p) for p in history['prices']])
+    data = fjson.dumps(history, float_format=float_format)
+    # reduce JSON size by removing spaces
+    data = data.replace(': ', ':').replace(', ', ',')
+    with open(filename, 'w') as f:
+        f.write(data)
+
+class Checkpointer:
+    # saves a price history which is being calculated every so many slots or
+    # seconds, writing it in full the first time and only appending after that.
+    # The saved prices can be released from the history, which then only holds
+    # those after them
+    def __init__(self, filename, slots=CHECKPOINT_SLOTS, interval=CHECKPOINT_INTERVAL):
+        self.filename = filename
+        self.slots = slots
+        self.interval = interval
+        self.saved = None # number of prices known to be on disk
+        self.released = 0 # number of them no longer in the history's prices
+        self.last_time = time.time()
+
+    def resume(self, length):
+        # continue a history whose first length prices are already saved, with
+        # only the prices after them in its prices
+        self.saved = self.released = length
+
+    def update(self, history, force=False):
+        # save history if a checkpoint is due (or force is set), unless checkpoints
+        # are disabled by setting both slots and interval to None, returning whether
+        # it was saved
+        if not (self.slots or self.interval):
+            return False
+        length = self.released + len(history['prices'])
+        pending = length - (self.saved or 0)
+        due = force or (self.slots and pending >= self.slots) or \
+              (self.interval and time.time() - self.last_time >= self.interval)
+        if not due or self.saved == length:
+            return False
+
+        if self.saved is None:
+            save_prices(self.filename, history)
+        else:
+            append_prices(self.filename, history['prices'][self.saved-self.released:])
+        self.saved = length
+        self.last_time = time.time()
+        return True
+
+    def release(self, history):
+        # drop the saved prices from history's prices (a list), returning the saved
+        # history memory-mapped
+        del history['prices'][:self.saved-self.released]
+        self.released = self.saved
+        return load_prices(self.filename)
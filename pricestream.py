@@ -0,0 +1,47 @@
+from datetime import datetime
+
+import numpy as np
+
+READ_CHUNK = 10000 # slots of a stored price history read into memory at a time
+
+# price histories as streams, for consumers which don't need (or can't hold) a whole
+# history at once. A stream is built from pieces: (slot index, prices) pairs covering
+# consecutive runs of Blocktimes slots, such as those read from a stored history by
+# history_pieces or calculated by AssetRegister.iter_calculated_prices
+
+def history_pieces(history, chunk_size=READ_CHUNK):
+    # the prices of a history dict chunk_size slots at a time. For a memory mapped
+    # history each piece is only read from disk when it is used
+    start, length = history['start_index'], len(history['prices'])
+    for i in range(0, length, chunk_size):
+        yield start + i, history['prices'][i:i+chunk_size]
+
+def stream_records(blocktimes, pieces):
+    # a (datetime, block, price) record for each slot of the pieces, with the
+    # datetime of the slot's block as a naive datetime in UTC (unlike
+    # Blocktimes.datetimes, which are in local time)
+    for start, prices in pieces:
+        end = start + len(prices)
+        blocks = blocktimes.arrays()[0][start:end].tolist()
+        times = blocktimes.timestamps(start, end).tolist()
+        for t, block, price in zip(times, blocks, np.asarray(prices, dtype=float).tolist()):
+            yield datetime.utcfromtimestamp(t), block, price
+
+def stream_chunks(blocktimes, pieces, chunk_size):
+    # the slots of the pieces as (times, blocks, prices) arrays of chunk_size slots
+    # (the last may be shorter), with times as datetime64[s] UTC
+    first, pending = None, np.empty(0)
+    for start, prices in pieces:
+        if first is None:
+            first = start
+        pending = np.concatenate((pending, np.asarray(prices, dtype=float)))
+        while len(pending) >= chunk_size:
+            yield make_chunk(blocktimes, first, pending[:chunk_size])
+            first, pending = first + chunk_size, pending[chunk_size:]
+    if len(pending):
+        yield make_chunk(blocktimes, first, pending)
+
+def make_chunk(blocktimes, start, prices):
+    end = start + len(prices)
+    return (blocktimes.timestamps(start, end).astype('datetime64[s]'),
+            blocktimes.arrays()[0][start:end], prices)
@@ -0,0 +1,181 @@
+import os
+import json
+
+import numpy as np
+
+from blocktimes import Blocktimes
+from metrics import metrics
+from pricematrix import PriceMatrix, to_datetime64
+from pricestore import append_prices, load_prices, meta_filename, save_prices, write_atomic
+from rpc import BATCH_SIZE
+
+LEVEL_FACTORS = (4, 16, 64) # coarse levels, in multiples of the Blocktimes delta
+REFINE_SEGMENT = 86400 # seconds of finer slots calculated (and cached) together
+REFINED_DIR = 'data/refined/'
+
+class PricePyramid:
+    # a token's price history at several resolutions. The base level is the history
+    # calculated on the AssetRegister's Blocktimes; coarser levels hold every
+    # factor-th price of it and are saved alongside, so that wide queries only read a
+    # fraction of the data; finer resolutions are calculated for the window asked
+    # for, a segment of REFINE_SEGMENT seconds at a time, and the segments cached
+    def __init__(self, asset_register, identifier, factors=LEVEL_FACTORS,
+                 refined_dir=REFINED_DIR, batch_size=BATCH_SIZE, from_logs=False):
+        self.asset_register = asset_register
+        token_info = asset_register.get_token_info(identifier)
+        self.symbol, self.address = token_info['symbol'], token_info['address']
+        self.factors = sorted(factors)
+        self.refined_dir = refined_dir
+        self.batch_size = batch_size
+        self.from_logs = from_logs
+
+    @property
+    def delta(self):
+        return self.asset_register.blocktimes.delta
+
+    def level_filename(self, factor):
+        return self.asset_register.price_filename(self.address) + f".x{factor}"
+
+    def base_version(self):
+        # modification time of the saved base history's metadata, which is rewritten
+        # whenever the history is saved, appended to or truncated
+        try:
+            return os.stat(meta_filename(
+                self.asset_register.price_filename(self.address))).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def build(self):
+        # bring the saved coarse levels up to date with the base history, only
+        # appending to those which were built from an earlier part of it. Each level
+        # records the version of the base it was built from
+        base = self.asset_register.price_histories[self.address]
+        version = self.base_version()
+        for factor in self.factors:
+            level = sample(base, factor)
+            filename = self.level_filename(factor)
+            try:
+                saved = load_prices(filename, mmap=False)
+            except FileNotFoundError:
+                saved = None
+            if saved and saved['start_index'] == level['start_index'] and \
+               len(saved['prices']) <= len(level['prices']) and \
+               np.array_equal(saved['prices'], level['prices'][:len(saved['prices'])]):
+                if len(saved['prices']) < len(level['prices']):
+                    append_prices(filename, level['prices'][len(saved['prices']):])
+            else:
+                save_prices(filename, level)
+            with open(meta_filename(filename)) as f:
+                meta = json.load(f)
+            if meta.get('base_version') != version:
+                meta['base_version'] = version
+                write_atomic(meta_filename(filename), json.dumps(meta))
+
+    def level(self, factor=1):
+        # price history dict of a level, with start_index counted in its own slots.
+        # A saved level which doesn't match the base history (which has grown or been
+        # recalculated since build, even to the same length) is passed over for a
+        # sample of the base
+        base = self.asset_register.price_histories[self.address]
+        if factor == 1:
+            return base
+        level = sample(base, factor)
+        try:
+            saved = load_prices(self.level_filename(factor))
+        except FileNotFoundError:
+            return level
+        if saved['start_index'] != level['start_index'] or \
+           len(saved['prices']) != len(level['prices']) or \
+           saved.get('base_version') != self.base_version():
+            return level
+        return saved
+
+    def query(self, start=None, end=None, resolution=None, max_points=None):
+        # prices between times start and end (datetimes, datetime64 or timestamps)
+        # as a single column PriceMatrix. The resolution is the spacing of the
+        # prices in seconds: levels coarser than the base are used for multiples of
+        # its delta, and prices are calculated for finer ones. Alternatively, with
+        # max_points, the finest level giving no more than max_points prices is used
+        if resolution is not None and resolution < self.delta:
+            if start is None or end is None:
+                raise ValueError('refined queries need both a start and an end')
+            return self.refine(start, end, resolution)
+
+        factors = [1] + self.factors
+        if resolution is not None:
+            factor = max(f for f in factors if f * self.delta <= resolution)
+        elif max_points is not None:
+            base = self.matrix(1).slice(start, end)
+            factor = next((f for f in factors if -(-len(base) // f) <= max_points),
+                          factors[-1])
+        else:
+            factor = 1
+        return self.matrix(factor).slice(start, end)
+
+    def matrix(self, factor):
+        # a whole level as a PriceMatrix, made of views of the saved prices
+        history = self.level(factor)
+        start, length = history['start_index'], len(history['prices'])
+        times = self.asset_register.blocktimes.timestamps(
+            start * factor, (start + length - 1) * factor + 1)[::factor]
+        return PriceMatrix(times.astype('datetime64[s]'), [self.symbol],
+                           np.asarray(history['prices'], dtype=float)[:, None], start,
+                           self.delta * factor)
+
+    def refine(self, start, end, resolution):
+        # prices every resolution seconds between start and end, calculated a segment
+        # at a time, with segments that are complete cached in refined_dir
+        if REFINE_SEGMENT % resolution:
+            raise ValueError(f"resolution must divide {REFINE_SEGMENT} seconds")
+        start = int(to_datetime64(start).astype(np.int64))
+        end = int(to_datetime64(end).astype(np.int64))
+
+        first_segment = start // REFINE_SEGMENT * REFINE_SEGMENT
+        times, prices = [], []
+        for seg_start in range(first_segment, end, REFINE_SEGMENT):
+            seg_times, seg_prices = self.refined_segment(seg_start, resolution)
+            times.append(seg_times)
+            prices.append(seg_prices)
+        times = np.concatenate(times).astype('datetime64[s]')
+        prices = np.concatenate(prices)
+        return PriceMatrix(times, [self.symbol], prices[:, None],
+                           first_segment // resolution, resolution).slice(start, end)
+
+    def refined_segment(self, seg_start, resolution):
+        # (block timestamps, prices) of the slots in a segment
+        filename = os.path.join(self.refined_dir,
+                                f"{self.address.lower()}.{resolution}.{seg_start}")
+        if os.path.exists(meta_filename(filename + '.prices')):
+            blocktimes = Blocktimes(filename=filename + '.blocktimes.json')
+            history = load_prices(filename + '.prices')
+            return blocktimes.timestamps(), history['prices']
+
+        ar = self.asset_register
+        with metrics.stage('refine', token=self.symbol):
+            blocktimes = Blocktimes(start_ts=seg_start, delta=resolution,
+                                    end_ts=seg_start + REFINE_SEGMENT - resolution,
+                                    web3=ar.web3,
+                                    timestamps_filename=ar.blocktimes.timestamps_filename)
+            step, get_prices = ar.get_price_getter(self.batch_size, self.from_logs)
+            prices = []
+            for i in range(0, len(blocktimes.block_nums), step):
+                blocks = blocktimes.block_nums[i:i+step]
+                prices += [price if price else 0 for price in get_prices(self.address,
+                                                                         blocks)]
+        prices = np.array(prices, dtype=float)
+
+        # a segment running past the latest block isn't complete, so isn't cached
+        if len(prices) == REFINE_SEGMENT // resolution:
+            os.makedirs(self.refined_dir, exist_ok=True)
+            blocktimes.save(filename + '.blocktimes.json')
+            save_prices(filename + '.prices', {'symbol': self.symbol, 'address': self.address,
+                                               'start_index': seg_start // resolution,
+                                               'prices': prices})
+        return blocktimes.timestamps(), prices
+
+def sample(history, factor):
+    # every factor-th price of a history, at the slots whose index is a multiple of
+    # factor, as a history whose start_index is counted in steps of factor slots
+    first = -history['start_index'] % factor
+    return dict(history, start_index=(history['start_index'] + first) // factor,
+                prices=np.asarray(history['prices'])[first::factor])
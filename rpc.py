@@ -0,0 +1,244 @@
+import time
+import asyncio
+import threading
+import concurrent.futures
+
+import requests
+from requests.adapters import HTTPAdapter
+from web3 import HTTPProvider, IPCProvider, Web3, WebsocketProvider
+from web3.providers import BaseProvider
+from websockets.exceptions import ConnectionClosed
+
+from metrics import MeteredHTTPProvider, metrics
+from rpccache import DEFAULT_FILENAME as RPC_CACHE_FILENAME, MAX_SIZE, CachedHTTPProvider, \
+                     CachingMixin
+
+BATCH_SIZE = 200 # maximum number of JSON-RPC requests sent in a single batch
+LOG_CHUNK_SIZE = 5000 # number of blocks covered by a single eth_getLogs request
+POOL_SIZE = 32 # number of keep-alive connections kept open to each node
+MAX_IN_FLIGHT = 8 # maximum number of requests outstanding at each node of a NodePool
+RETRY_INTERVAL = 30 # seconds before a node which failed is tried again
+# errors which mean that a node (or the connection to it) has failed, rather than
+# the request. Those raised by requests and sockets are all OSErrors, but a closed
+# WebSocket connection, or one which times out, raises its own
+FAILOVER_EXCEPTIONS = (OSError, ConnectionClosed, asyncio.TimeoutError,
+                       concurrent.futures.TimeoutError)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def connect(node_url, cache_filename=None):
+    # Web3 instance for node_url, with responses at historical blocks cached in
+    # cache_filename unless it is None. node_url may also be a list of endpoints (or
+    # a comma separated string of them), each an HTTP or WebSocket URL or the path
+    # to an IPC socket, in which case requests are spread between them by a NodePool
+    endpoints = node_url.split(',') if isinstance(node_url, str) else list(node_url)
+    if len(endpoints) == 1 and endpoints[0].startswith(('http://', 'https://')):
+        if cache_filename is None:
+            return Web3(MeteredHTTPProvider(endpoints[0]))
+        return Web3(CachedHTTPProvider(endpoints[0], cache_filename))
+    if cache_filename is None:
+        return Web3(NodePool(endpoints))
+    return Web3(CachedNodePool(endpoints, cache_filename))
+
+def get_session(uri):
+    # requests session for uri, shared by all threads, keeping up to POOL_SIZE
+    # connections to it alive
+    with _sessions_lock:
+        if uri not in _sessions:
+            session = requests.Session()
+            session.mount(uri, HTTPAdapter(pool_maxsize=POOL_SIZE))
+            _sessions[uri] = session
+        return _sessions[uri]
+
+def block_param(block):
+    # format a block identifier the way the JSON-RPC API expects it
+    if isinstance(block, int):
+        return hex(block)
+    return block
+
+def eth_call(contract, fn_name, args, block='latest'):
+    # JSON-RPC request equivalent to contract.functions.fn_name(*args).call()
+    data = contract.encodeABI(fn_name=fn_name, args=args)
+    return 'eth_call', [{'to': contract.address, 'data': data}, block_param(block)]
+
+def post_batch(provider, requests_):
+    # send a list of (method, params) requests to an HTTP provider as a single
+    # JSON-RPC batch, returning the results in the order of the requests. Only
+    # those not in the provider's cache, if it has one, are sent
+    send = getattr(provider, 'make_batch_request', None) or \
+           (lambda requests_: send_batch(provider, requests_))
+    cache = getattr(provider, 'cache', None)
+    if cache is not None:
+        return cache.read_through(requests_, send)
+    return send(requests_)
+
+def send_batch(provider, requests_):
+    payload = [{'jsonrpc': '2.0', 'method': method, 'params': params, 'id': i}
+               for i, (method, params) in enumerate(requests_)]
+    start = time.time()
+    try:
+        if isinstance(provider, HTTPProvider):
+            uri = provider.endpoint_uri
+            response = get_session(uri).post(uri, json=payload,
+                                             **provider.get_request_kwargs())
+            response.raise_for_status()
+            responses = response.json()
+        else:
+            # other providers don't support batches, so get one request at a time
+            responses = [dict(provider.make_request(r['method'], r['params']), id=r['id'])
+                         for r in payload]
+    except Exception:
+        metrics.record_request('batch', time.time() - start, error=True)
+        raise
+    errors = {r['id'] for r in responses if 'error' in r}
+    metrics.record_request('batch', time.time() - start, error=bool(errors))
+    for i, (method, _) in enumerate(requests_):
+        metrics.record_request(method, error=i in errors)
+
+    results = [None] * len(payload)
+    for r in responses:
+        if 'error' in r:
+            raise ValueError(r['error'])
+        results[r['id']] = r['result']
+    return results
+
+def batch_request(web3, requests_, batch_size=BATCH_SIZE):
+    # send any number of (method, params) requests in batches of batch_size
+    results = []
+    for i in range(0, len(requests_), batch_size):
+        results += post_batch(web3.provider, requests_[i:i + batch_size])
+    return results
+
+def get_logs(web3, address, topics, from_block, to_block, chunk_size=LOG_CHUNK_SIZE):
+    # fetch the logs matching address and topics between from_block and to_block
+    # (inclusive), splitting the range into chunks of chunk_size blocks
+    logs = []
+    for start in range(from_block, to_block + 1, chunk_size):
+        end = min(start + chunk_size - 1, to_block)
+        logs += web3.eth.getLogs({'address': address, 'topics': topics,
+                                  'fromBlock': start, 'toBlock': end})
+    return logs
+
+class PooledHTTPProvider(HTTPProvider):
+    # HTTPProvider whose requests, from any thread, share the connections kept
+    # alive by get_session with the batches sent by send_batch
+    def make_request(self, method, params):
+        response = get_session(self.endpoint_uri).post(
+            self.endpoint_uri, data=self.encode_rpc_request(method, params),
+            **self.get_request_kwargs())
+        response.raise_for_status()
+        return self.decode_rpc_response(response.content)
+
+def make_provider(endpoint):
+    # provider for a single endpoint, given by its URL or IPC socket path
+    if endpoint.startswith(('http://', 'https://')):
+        return PooledHTTPProvider(endpoint)
+    if endpoint.startswith(('ws://', 'wss://')):
+        return WebsocketProvider(endpoint)
+    return IPCProvider(endpoint)
+
+class PoolNode:
+    def __init__(self, endpoint, max_in_flight=MAX_IN_FLIGHT):
+        self.endpoint = endpoint
+        self.provider = make_provider(endpoint)
+        # a WebsocketProvider shares one connection between all threads without a
+        # lock, so only one request at a time can be sent over it
+        self.max_in_flight = 1 if isinstance(self.provider, WebsocketProvider) \
+                             else max_in_flight
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.down_until = 0 # time before which the node is not used, after failing
+
+class NodePool(BaseProvider):
+    # provider which spreads requests between several nodes, sending each to the
+    # node with the fewest requests in flight, up to max_in_flight at each node (one
+    # at WebSocket nodes). A node which fails is left for retry_interval seconds
+    # while its requests go to the others, and only if every node fails does the
+    # request fail
+    def __init__(self, endpoints, max_in_flight=MAX_IN_FLIGHT,
+                 retry_interval=RETRY_INTERVAL):
+        self.nodes = [PoolNode(endpoint.strip(), max_in_flight) for endpoint in endpoints]
+        self.retry_interval = retry_interval
+        self.condition = threading.Condition()
+
+    def acquire(self, tried):
+        # reserve the least loaded healthy node not in tried, waiting for one to be
+        # free if they are all busy, or return None if every node has been tried
+        with self.condition:
+            while True:
+                nodes = [node for node in self.nodes if node not in tried]
+                if not nodes:
+                    return None
+                now = time.time()
+                # if every node is down, try the one due to come back first
+                healthy = [node for node in nodes if node.down_until <= now] or \
+                          [min(nodes, key=lambda node: node.down_until)]
+                free = [node for node in healthy if node.in_flight < node.max_in_flight]
+                if free:
+                    node = min(free, key=lambda node: (node.in_flight, node.requests))
+                    node.in_flight += 1
+                    node.requests += 1
+                    return node
+                self.condition.wait()
+
+    def release(self, node, failed=False):
+        with self.condition:
+            node.in_flight -= 1
+            if failed:
+                node.failures += 1
+                node.down_until = time.time() + self.retry_interval
+            else:
+                node.down_until = 0
+            self.condition.notify_all()
+
+    def run(self, func):
+        # return func(provider) for the provider of a node, failing over to the
+        # other nodes in turn if it fails
+        tried, error = [], None
+        while True:
+            node = self.acquire(tried)
+            if node is None:
+                raise error
+            tried.append(node)
+            try:
+                result = func(node.provider)
+            except FAILOVER_EXCEPTIONS as e:
+                self.release(node, failed=True)
+                error = e
+                continue
+            except BaseException:
+                self.release(node)
+                raise
+            self.release(node)
+            return result
+
+    def make_request(self, method, params):
+        start = time.time()
+        try:
+            response = self.run(lambda provider: provider.make_request(method, params))
+        except Exception:
+            metrics.record_request(method, time.time() - start, error=True)
+            raise
+        metrics.record_request(method, time.time() - start, error='error' in response)
+        return response
+
+    def make_batch_request(self, requests_):
+        # results of a list of (method, params) requests, sent to a single node
+        return self.run(lambda provider: send_batch(provider, requests_))
+
+    def isConnected(self):
+        return any(node.provider.isConnected() for node in self.nodes)
+
+    def status(self):
+        now = time.time()
+        return [{'endpoint': node.endpoint, 'in_flight': node.in_flight,
+                 'requests': node.requests, 'failures': node.failures,
+                 'healthy': node.down_until <= now} for node in self.nodes]
+
+class CachedNodePool(CachingMixin, NodePool):
+    def __init__(self, endpoints, cache_filename=RPC_CACHE_FILENAME, max_size=MAX_SIZE,
+                 **kwargs):
+        super().__init__(endpoints, **kwargs)
+        self.init_cache(cache_filename, max_size)
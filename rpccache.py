@@ -0,0 +1,191 @@
+import json
+import atexit
+import sqlite3
+import threading
+
+from metrics import MeteredHTTPProvider
+
+DEFAULT_FILENAME = 'data/rpccache.sqlite'
+MAX_SIZE = 2 ** 30 # bytes of responses kept before the least recently used are evicted
+COMMIT_INTERVAL = 1000 # number of writes between commits
+# methods whose result is fixed once the block(s) they refer to are, with the
+# position of the block parameter. Block headers are not cached, since
+# Blocktimes already keeps the timestamps it needs in a TimestampStore
+CACHED_METHODS = {'eth_call': 1, 'eth_getBalance': 1, 'eth_getCode': 1,
+                  'eth_getStorageAt': 2, 'eth_getLogs': 0}
+# methods whose result can't change while connected to a node, which are remembered
+# by the provider but not stored, in case the node behind the URL changes
+CONSTANT_METHODS = ('eth_chainId', 'net_version')
+
+_caches = {}
+
+def is_block_number(block):
+    # True for a block given as a number, rather than a tag such as 'latest'
+    return isinstance(block, int) or isinstance(block, str) and block.startswith('0x')
+
+def cache_key(method, params, max_block=None):
+    # key under which the response to a request is cached, or None for requests
+    # which may return a different result when repeated, including those at blocks
+    # after max_block (if given), which could still be replaced by a reorganisation
+    if method not in CACHED_METHODS:
+        return None
+    block = params[CACHED_METHODS[method]] if len(params) > CACHED_METHODS[method] \
+            else 'latest'
+    if method == 'eth_getLogs':
+        if 'blockHash' in block:
+            return None
+        concrete = is_block_number(block.get('fromBlock')) and \
+                   is_block_number(block.get('toBlock'))
+        block = block.get('toBlock')
+    else:
+        concrete = is_block_number(block)
+    if not concrete:
+        return None
+    if max_block is not None and \
+       (block if isinstance(block, int) else int(block, 16)) > max_block:
+        return None
+    return json.dumps([method, params], sort_keys=True, separators=(',', ':')).lower()
+
+def get_cache(filename=DEFAULT_FILENAME, max_size=MAX_SIZE):
+    # caches are shared by everything in the process using the same file
+    if filename not in _caches:
+        _caches[filename] = RPCCache(filename, max_size)
+        atexit.register(_caches[filename].commit)
+    return _caches[filename]
+
+class RPCCache:
+    # on-disk store of JSON-RPC results for requests at fixed historical blocks,
+    # limited to max_size bytes by evicting the least recently used results
+    def __init__(self, filename=DEFAULT_FILENAME, max_size=MAX_SIZE):
+        self.filename = filename
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+        self.max_block = None # requests at later blocks aren't cached (see cache_key)
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, '
+                          'result TEXT NOT NULL, used INTEGER NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS used_index ON responses (used)')
+        self.size, self.clock = self.conn.execute(
+            'SELECT COALESCE(SUM(LENGTH(result)), 0), COALESCE(MAX(used), 0) '
+            'FROM responses').fetchone()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def get(self, key):
+        # (True, result) if key is cached, else (False, None)
+        with self.lock:
+            row = self.conn.execute('SELECT result FROM responses WHERE key = ?',
+                                    (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            self.clock += 1
+            self.conn.execute('UPDATE responses SET used = ? WHERE key = ?',
+                              (self.clock, key))
+            self.wrote()
+        return True, json.loads(row[0])
+
+    def put(self, key, result):
+        if result is None:
+            return
+        data = json.dumps(result, separators=(',', ':'))
+        with self.lock:
+            self.clock += 1
+            old = self.conn.execute('SELECT LENGTH(result) FROM responses WHERE key = ?',
+                                    (key,)).fetchone()
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+                              (key, data, self.clock))
+            self.size += len(data) - (old[0] if old else 0)
+            if self.size > self.max_size:
+                self.evict()
+            self.wrote()
+
+    def evict(self):
+        # remove the least recently used results until the cache is at 90% of max_size
+        excess = self.size - 0.9 * self.max_size
+        cutoff, freed = None, 0
+        for used, size in self.conn.execute(
+                'SELECT used, LENGTH(result) FROM responses ORDER BY used'):
+            cutoff, freed = used, freed + size
+            if freed >= excess:
+                break
+        self.conn.execute('DELETE FROM responses WHERE used <= ?', (cutoff,))
+        self.size -= freed
+
+    def wrote(self):
+        self.uncommitted += 1
+        if self.uncommitted >= COMMIT_INTERVAL:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def read_through(self, requests_, fetch):
+        # results of a list of (method, params) requests, taking those which are
+        # cached from the cache and the rest from fetch(requests), which is called at
+        # most once and must return their results in order
+        keys = [self.key(method, params) for method, params in requests_]
+        results, missing = [None] * len(requests_), []
+        for i, key in enumerate(keys):
+            found, result = self.get(key) if key else (False, None)
+            if found:
+                results[i] = result
+            else:
+                missing.append(i)
+
+        if missing:
+            for i, result in zip(missing, fetch([requests_[i] for i in missing])):
+                results[i] = result
+                if keys[i]:
+                    self.put(keys[i], result)
+        return results
+
+    def key(self, method, params):
+        return cache_key(method, params, self.max_block)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self),
+                'size': self.size}
+
+class CachingMixin:
+    # provider mixin which answers requests at historical blocks from an RPCCache,
+    # only passing on those it hasn't seen before. rpc.post_batch uses the cache
+    # too, so batched requests are covered as well
+    def init_cache(self, cache_filename=DEFAULT_FILENAME, max_size=MAX_SIZE):
+        self.cache = get_cache(cache_filename, max_size)
+        self.constants = {}
+
+    def make_request(self, method, params):
+        if method in CONSTANT_METHODS:
+            if method not in self.constants:
+                response = super().make_request(method, params)
+                if 'result' not in response:
+                    return response
+                self.constants[method] = response
+            return self.constants[method]
+
+        key = self.cache.key(method, params)
+        if key is None:
+            return super().make_request(method, params)
+        found, result = self.cache.get(key)
+        if found:
+            return {'jsonrpc': '2.0', 'id': 0, 'result': result}
+        response = super().make_request(method, params)
+        if 'result' in response:
+            self.cache.put(key, response['result'])
+        return response
+
+class CachedHTTPProvider(CachingMixin, MeteredHTTPProvider):
+    def __init__(self, endpoint_uri, cache_filename=DEFAULT_FILENAME, max_size=MAX_SIZE,
+                 **kwargs):
+        super().__init__(endpoint_uri, **kwargs)
+        self.init_cache(cache_filename, max_size)
@@ -0,0 +1,148 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from assetregister import AssetRegister
+from metrics import metrics
+from pricestore import load_prices, meta_filename, save_prices
+from rpc import BATCH_SIZE
+from utils import progress_string
+
+SHARD_SLOTS = 2000 # number of slots priced by each task
+SHARD_DIR = 'data/shards/'
+SHARD_RETRIES = 3 # times the shards which failed are calculated again
+
+_register = None # the AssetRegister of a worker process
+
+class ShardedPriceEngine:
+    # calculates a single token's price history with a pool of worker processes,
+    # each with its own connection to the node, splitting the slots still to be
+    # priced into shards of shard_slots slots. Every shard is saved to shard_dir as
+    # soon as it is done, so shards which fail are calculated again on their own, and
+    # a run which is interrupted only has to calculate the shards it didn't finish.
+    # The workers don't share the RPC cache (an SQLite file) or report their requests
+    # to metrics: each builds its own exchanges, on its own connection, from the
+    # exchange metadata found by the main process
+    def __init__(self, asset_register, workers=None, shard_slots=SHARD_SLOTS,
+                 shard_dir=SHARD_DIR, batch_size=BATCH_SIZE, from_logs=False,
+                 retries=SHARD_RETRIES):
+        self.asset_register = asset_register
+        self.workers = workers or os.cpu_count()
+        self.shard_slots = shard_slots
+        self.shard_dir = shard_dir
+        self.batch_size = batch_size
+        self.from_logs = from_logs
+        self.retries = retries
+
+    def run(self, identifier, clear_existing=False):
+        # calculate the token's history (continuing the existing one unless
+        # clear_existing is set) and store it in price_histories, saved to disk
+        ar = self.asset_register
+        token_info = ar.get_token_info(identifier)
+        symbol, address = token_info['symbol'], token_info['address']
+        block_nums = ar.blocktimes.block_nums
+        ar.get_exchange(identifier)
+
+        if address in ar.price_histories and not clear_existing:
+            start_ind = ar.price_histories[address]['start_index']
+            prices = list(ar.price_histories[address]['prices'])
+            continue_from = start_ind + len(prices)
+        else:
+            # every slot after the exchanges were deployed is priced, and the start
+            # found from the prices afterwards rather than searched for first
+            deploy_num = ar.get_deploy_block(identifier)
+            start_ind = None
+            continue_from = next(i for i, n in enumerate(block_nums) if n > deploy_num)
+            prices = []
+
+        shards = [(i, block_nums[i:i+self.shard_slots])
+                  for i in range(continue_from, len(block_nums), self.shard_slots)]
+        with metrics.stage('pricing', token=symbol):
+            self.calculate_shards(symbol, address, shards)
+
+        for first, blocks in shards:
+            prices += load_prices(self.shard_filename(address, first, blocks),
+                                  mmap=False)['prices'].tolist()
+
+        # as in find_start_index, the history starts at the first slot with a price,
+        # or at the last slot if there are none
+        if start_ind is None:
+            skip = next((k for k, p in enumerate(prices) if p), len(prices) - 1)
+            start_ind, prices = continue_from + skip, prices[skip:]
+
+        history = {'symbol':symbol, 'address':address, 'start_index':start_ind,
+                   'prices':prices}
+        ar.price_histories[address] = history
+        save_prices(ar.price_filename(address), history)
+
+        for first, blocks in shards:
+            filename = self.shard_filename(address, first, blocks)
+            os.remove(filename)
+            os.remove(meta_filename(filename))
+
+    def calculate_shards(self, symbol, address, shards):
+        # make sure there is a saved file for each of the shards, calculating those
+        # which aren't there yet. The shards which fail are tried again, up to
+        # retries times, each time in a new pool in case a worker process has died
+        os.makedirs(self.shard_dir, exist_ok=True)
+        ar = self.asset_register
+        pending = [(first, blocks) for first, blocks in shards
+                   if not self.shard_done(address, first, blocks)]
+        total, done = len(pending), 0
+        start_time = time.time()
+        prog = ''
+        for _ in range(self.retries + 1):
+            if not pending:
+                break
+            failed, error = [], None
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                     initargs=(ar.node_url, ar.token_lookup,
+                                               ar.exchange_metadata)) as executor:
+                futures = {executor.submit(price_shard, symbol, address, first, blocks,
+                                           self.shard_filename(address, first, blocks),
+                                           self.batch_size, self.from_logs):
+                           (first, blocks) for first, blocks in pending}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed.append(futures[future])
+                        error = e
+                        continue
+                    prog = progress_string(done, total, start_time)
+                    print(prog, end='\r')
+                    done += 1
+            pending = sorted(failed, key=lambda shard: shard[0])
+        print(' ' * len(prog), end='\r')
+        if pending:
+            raise error
+
+    def shard_filename(self, address, first, blocks):
+        return os.path.join(self.shard_dir,
+                            f"{address.lower()}.{first}.{blocks[0]}.{blocks[-1]}.prices")
+
+    def shard_done(self, address, first, blocks):
+        try:
+            meta = load_prices(self.shard_filename(address, first, blocks))
+        except FileNotFoundError:
+            return False
+        return meta['start_index'] == first and len(meta['prices']) == len(blocks)
+
+def init_worker(node_url, token_lookup, exchange_metadata):
+    # set up the AssetRegister of a worker process, with its own connection to the
+    # node and the exchanges already found by the main process
+    global _register
+    _register = AssetRegister(node_url, tokens_filename=None, blocktimes_filename=None,
+                              exchanges_filename=None, rpc_cache_filename=None)
+    _register.token_lookup = token_lookup
+    _register.exchange_metadata = exchange_metadata
+
+def price_shard(symbol, address, first, blocks, filename, batch_size, from_logs):
+    # price the blocks of a shard in a worker process, saving them to filename as a
+    # partial history starting at slot first
+    step, get_prices = _register.get_price_getter(batch_size, from_logs)
+    prices = []
+    for i in range(0, len(blocks), step):
+        prices += [price if price else 0 for price in get_prices(address, blocks[i:i+step])]
+    save_prices(filename, {'symbol':symbol, 'address':address, 'start_index':first,
+                           'prices':prices})
@@ -0,0 +1,81 @@
+import sqlite3
+import threading
+
+DEFAULT_FILENAME = 'data/timestamps.sqlite'
+COMMIT_INTERVAL = 1000 # number of new timestamps written between commits
+
+class TimestampStore:
+    # on-disk record of block number -> timestamp for every block fetched from the
+    # node, so that no historical block header ever needs to be fetched twice
+    def __init__(self, filename=DEFAULT_FILENAME):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS timestamps '
+                          '(block INTEGER PRIMARY KEY, timestamp INTEGER NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS timestamp_index '
+                          'ON timestamps (timestamp)')
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM timestamps').fetchone()[0]
+
+    def timestamp_of(self, block):
+        # timestamp of block, or None if it has not been stored
+        with self.lock:
+            row = self.conn.execute('SELECT timestamp FROM timestamps WHERE block = ?',
+                                    (block,)).fetchone()
+        return row[0] if row else None
+
+    def block_at(self, ts):
+        # first block with a timestamp at or after ts, or None if the stored blocks
+        # aren't enough to be sure of it (i.e. the block before it is not stored)
+        with self.lock:
+            row = self.conn.execute('SELECT block FROM timestamps WHERE timestamp >= ? '
+                                    'ORDER BY timestamp LIMIT 1', (ts,)).fetchone()
+            if not row:
+                return None
+            block = row[0]
+            prev = self.conn.execute('SELECT timestamp FROM timestamps WHERE block = ?',
+                                     (block - 1,)).fetchone()
+        if block == 0 or prev and prev[0] < ts:
+            return block
+        return None
+
+    def bounds(self, ts):
+        # (block, timestamp) of the last stored block before ts and of the first at
+        # or after it, either of which is None if there is no such block stored
+        with self.lock:
+            below = self.conn.execute('SELECT block, timestamp FROM timestamps WHERE '
+                                      'timestamp < ? ORDER BY timestamp DESC LIMIT 1',
+                                      (ts,)).fetchone()
+            above = self.conn.execute('SELECT block, timestamp FROM timestamps WHERE '
+                                      'timestamp >= ? ORDER BY timestamp LIMIT 1',
+                                      (ts,)).fetchone()
+        return below, above
+
+    def add(self, block, ts):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO timestamps VALUES (?, ?)', (block, ts))
+            self.uncommitted += 1
+            if self.uncommitted >= COMMIT_INTERVAL:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def discard_after(self, block):
+        # forget the timestamps of the blocks after block, which may have been
+        # replaced by a reorganisation of the chain
+        with self.lock:
+            self.conn.execute('DELETE FROM timestamps WHERE block > ?', (block,))
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -45,3 +45,18 @@ def progress_string(current_iteration, total_iterations, start_time):
     elapsed = time.strftime("%H:%M:%S", time.gmtime(time.time() - start_time))
     return (f"{current_iteration+1} of {total_iterations} "
             f"({100*(current_iteration+1)/total_iterations:.2f}% complete) in {elapsed}")
+
+def retry(func, retries=5, backoff=1, exceptions=(OSError, ValueError)):
+    # wrap func so that calls raising one of exceptions (connection problems and
+    # node errors) are retried, waiting twice as long after each failure
+    def wrapped(*args, **kwargs):
+        for attempt in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except exceptions as e:
+                if attempt == retries:
+                    raise
+                wait = backoff * 2 ** attempt
+                print(f"{e!r}, retrying in {wait}s")
+                time.sleep(wait)
+    return wrapped